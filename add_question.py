@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from engines import make_engine
 from app import Question
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
@@ -24,21 +25,61 @@ rollback / r:    rollback changes
     exit / e:    exit
 """
 
+CHUNK_SIZE = 1000
+
+
+def _chunks(lines, size):
+    """Yields lists of up to size normalized question texts from lines,
+    skipping blank lines and texts already yielded"""
+    seen = set()
+    chunk = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        text = line.strip()
+        if text and text not in seen:
+            seen.add(text)
+            chunk.append(text)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_questions(lines, session, chunk_size=CHUNK_SIZE):
+    """Adds a question for every distinct line not already in the
+    database, checking and inserting chunk_size questions per query.
+    Returns the lists of added and already existing texts."""
+    table = Question.__table__
+    added, existing = [], []
+    for chunk in _chunks(lines, chunk_size):
+        found = set(text for text, in session.execute(
+            sa.select([table.c.text]).where(table.c.text.in_(chunk))))
+        new = [text for text in chunk if text not in found]
+        if new:
+            session.execute(table.insert(), [{'text': t} for t in new])
+        added.extend(new)
+        existing.extend(text for text in chunk if text in found)
+    return added, existing
+
+
+def import_file(filename, session):
+    """Imports the questions in filename, printing what happened"""
+    with open(filename) as questions:
+        added, existing = import_questions(questions, session)
+    for q in existing:
+        print "Already in DB:", q
+    print "Added", len(added), "questions"
+
 
 if __name__ == '__main__':
-    engine = sa.create_engine(DATABASE_URL)
+    engine = make_engine(DATABASE_URL)
     session = sessionmaker(autoflush=True)
     session.configure(bind=engine)
     sess = session()
     if sys.argv[-1] != "add_question.py" and os.path.isfile(sys.argv[-1]):
-        with open(sys.argv[-1]) as questions:
-            for q in questions.read().split("\n"):
-                q = unicode(q)
-                if not sess.query(Question).filter(Question.text == q).all():
-                    Question.new(q, sess)
-                    print "Added ", q
-                else:
-                    print "Already in DB:", q
+        import_file(sys.argv[-1], sess)
         if raw_input("Are you sure you want to commit? (Y/N)\n>"
                      ).lower() in ['y', 'yes']:
             sess.commit()
@@ -77,10 +118,7 @@ if __name__ == '__main__':
                 sess.rollback()
             elif inp in ["file", "f"]:
                 filename = raw_input("Enter path:\n>")
-                with open(filename) as file:
-                    questions = file.read().split("\n")
-                    for q in questions:
-                        Question.new(q, sess)
+                import_file(filename, sess)
             elif inp in ["help", "h"]:
                 print HELP
             elif inp in ["exit", "e"]:
@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 
 # python imports
+import logging
 import os
-from random import randint
+import threading
+from collections import OrderedDict
 # pyramid imports
 from pyramid.config import Configurator
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPFound
+from pyramid.tweens import INGRESS
 # security imports
 from pyramid.security import remember, forget
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
-from cryptacular.bcrypt import BCRYPTPasswordManager
 # sqlalchemy imports
 import sqlalchemy as sa
 from pyramid.response import Response
@@ -19,19 +21,59 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.sqlalchemy import ZopeTransactionExtension
 from sqlalchemy.ext.declarative import declarative_base
+import transaction
 # server imports
-from waitress import serve
+from waitress.server import create_server
 
 import numpy as np
-import urllib
-import urllib2
 import json
 
+import metrics
+import prefork
+import snapshot
+from engines import make_engine, settings_from_env
+from passwords import PasswordPool, PasswordPoolBusy
+from siteverify import SiteVerifier, CaptchaUnavailable, GOOGLE_URL
+from store import (AnswerStore, AnsweredSets, QuestionStats, respondents,
+                   set_bits)
+from writer import SubmissionWriter
+from predictors import (LstsqPredictor, RidgePredictor, PrecomputedPredictor,
+                        FactorizationPredictor, CachedPredictor)
+
 
 HERE = os.path.dirname(os.path.abspath(__file__))
+log = logging.getLogger(__name__)
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+# session for the prediction reads, on a replica when one is configured
+READ_SESSION = DBSession
 DATABASE_URL = os.environ.get('DATABASE_URL')
 Base = declarative_base()
+MIN_RESPONDENTS = 10
+ANSWER_STORE = AnswerStore()
+QUESTION_STATS = None
+# how many of the user's questions make_data keeps, 0 for all of them
+PREDICTOR_QUESTIONS = 0
+PREDICTOR = None
+SUBMISSION_LISTENERS = []
+# write-behind queue for submissions, None to write them in the request
+WRITER = None
+# questions answered by each recent user, None to look them up every time
+ANSWERED = None
+# bumped by every worker of a pre-fork server when it stores an answer,
+# None when serving from a single process
+GENERATION = None
+# the generation this process last caught up with, and the highest answer
+# id it has applied from the answers table
+SEEN_GENERATION = 0
+REPLAYED_ID = 0
+# answer ids below REPLAYED_ID read again on catching up, for answers
+# committed out of id order, and the ids in that window already applied
+REPLAY_OVERLAP = 100
+REPLAYED_RECENTLY = set()
+CATCH_UP_LOCK = threading.Lock()
+PASSWORDS = PasswordPool()
+RECAPTCHA_SECRET = '6Lfq1gkTAAAAADReh88NQ4TggHTEnLEONl1oCcn_'
+CAPTCHA = SiteVerifier(secret=RECAPTCHA_SECRET)
 
 
 # -Models-
@@ -45,10 +87,9 @@ class User(Base):
     @classmethod
     def new(cls, username=None, password=None, session=DBSession):
         """Stores password in database already hashed"""
-        manager = BCRYPTPasswordManager()
         if not (username and password):
             raise ValueError("Username and password needed")
-        hashed = unicode(manager.encode(password))
+        hashed = unicode(PASSWORDS.encode(password))
         try:
             instance = cls(username=username, password=hashed)
             session.add(instance)
@@ -90,20 +131,82 @@ class Question(Base):
     def get_question_by_id(cls, id, session=DBSession):
         return session.query(cls).filter(cls.id == id).one()
 
+    @classmethod
+    def _unanswered(cls, user, session=DBSession, exclude=()):
+        if ANSWERED is not None:
+            answered = set_bits(answered_bits(user.id)) + list(exclude)
+            query = session.query(cls)
+            if answered:
+                query = query.filter(~cls.id.in_(answered))
+            return query
+        answered = sa.exists().where(sa.and_(
+            Submission.question_id == cls.id,
+            Submission.user_id == user.id))
+        query = session.query(cls).filter(~answered)
+        pending = list(exclude)
+        if WRITER is not None:
+            pending += [question_id for question_id, _
+                        in WRITER.pending_answers(user.id)]
+        if pending:
+            query = query.filter(~cls.id.in_(pending))
+        return query
+
+    @classmethod
+    def get_unanswered(cls, user, session=DBSession):
+        """Returns every question the user has not answered"""
+        return cls._unanswered(user, session).all()
+
+    @classmethod
+    def get_random_unanswered(cls, user, session=DBSession, exclude=()):
+        """Returns a random question the user has not answered, or None.
+        The ids in exclude are left out too, for a question answered in
+        a transaction that has not been committed yet."""
+        return cls._unanswered(user, session, exclude).order_by(
+            sa.func.random()).limit(1).first()
+
 
 class Submission(Base):
-    """Stores answers tied to a user id and a question id"""
+    """Stores answers tied to a user id and a question id. The queries
+    feeding predictions are Core selects returning plain rows, skipping
+    the ORM's object loading and identity map."""
     __tablename__ = "answers"
+    __table_args__ = (
+        sa.UniqueConstraint('user_id', 'question_id',
+                            name='uq_answers_user_id_question_id'),
+        sa.Index('ix_answers_question_id_user_id_answer',
+                 'question_id', 'user_id', 'answer'),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
-    user_id = sa.Column(sa.Integer, nullable=False)
-    question_id = sa.Column(sa.Integer, nullable=False)
+    user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey('users.id', name='fk_answers_user_id',
+                      ondelete='CASCADE', deferrable=True,
+                      initially='DEFERRED'),
+        nullable=False)
+    question_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey('questions.id', name='fk_answers_question_id',
+                      ondelete='CASCADE', deferrable=True,
+                      initially='DEFERRED'),
+        nullable=False)
     answer = sa.Column(sa.Integer, nullable=False)
 
     @classmethod
     def new(cls, user, question, answer, session=DBSession):
+        """Records an answer. In write-behind mode the answer is queued,
+        None is returned and the prediction state hears about it at once;
+        otherwise it is added to the session and heard about after the
+        commit."""
+        if WRITER is not None and WRITER.submit(user.id, question.id,
+                                                int(answer)):
+            _submitted(True, user.id, question.id, answer)
+            return None
         instance = cls(user_id=user.id, question_id=question.id, answer=answer)
         session.add(instance)
+        if SUBMISSION_LISTENERS or ANSWERED is not None:
+            transaction.get().addAfterCommitHook(
+                _submitted, args=(user.id, question.id, answer))
         return instance
 
     @classmethod
@@ -124,6 +227,92 @@ class Submission(Base):
             cls.user_id == user.id).filter(cls.question_id == question.id
                                            ).one().answer
 
+    @classmethod
+    def get_question_answers(cls, question_ids, session=DBSession):
+        """Returns (user_id, question_id, answer, respondents) rows for every
+        answer to question_ids, where respondents is the total number of
+        answers to that row's question"""
+        table = cls.__table__
+        return session.execute(sa.select([
+            table.c.user_id,
+            table.c.question_id,
+            table.c.answer,
+            sa.func.count(table.c.id).over(
+                partition_by=table.c.question_id).label('respondents')
+        ]).where(table.c.question_id.in_(list(question_ids)))).fetchall()
+
+    @classmethod
+    def get_all_answers(cls, session=DBSession):
+        """Returns (user_id, question_id, answer) for every answer"""
+        table = cls.__table__
+        return session.execute(sa.select([
+            table.c.user_id, table.c.question_id, table.c.answer
+        ])).fetchall()
+
+    @classmethod
+    def exists(cls, user, question, session=DBSession):
+        """Tells whether the user has answered the question"""
+        if ANSWERED is not None:
+            return bool(answered_bits(user.id) >> question.id & 1)
+        if WRITER is not None and WRITER.is_pending(user.id, question.id):
+            return True
+        return session.query(sa.exists().where(sa.and_(
+            cls.user_id == user.id, cls.question_id == question.id))
+        ).scalar()
+
+    @classmethod
+    def get_answers_since(cls, last_id, session=DBSession):
+        """Returns (id, user_id, question_id, answer) for every answer with
+        an id above last_id, in id order"""
+        table = cls.__table__
+        return session.execute(sa.select([
+            table.c.id, table.c.user_id, table.c.question_id, table.c.answer
+        ]).where(table.c.id > last_id).order_by(table.c.id)).fetchall()
+
+    @classmethod
+    def get_last_id(cls, session=DBSession):
+        """Returns the highest answer id, 0 when there are no answers"""
+        return session.query(sa.func.coalesce(sa.func.max(cls.id), 0)
+                             ).scalar()
+
+    @classmethod
+    def get_answered_ids(cls, user_id, session=DBSession):
+        """Returns the ids of the questions a user has answered"""
+        table = cls.__table__
+        return [row[0] for row in session.execute(
+            sa.select([table.c.question_id]).where(
+                table.c.user_id == user_id)).fetchall()]
+
+    @classmethod
+    def get_user_answers(cls, user_id, session=DBSession):
+        """Returns (question_id, answer) pairs for a user in the order
+        they were submitted"""
+        table = cls.__table__
+        return session.execute(
+            sa.select([table.c.question_id, table.c.answer]).where(
+                table.c.user_id == user_id).order_by(table.c.id)).fetchall()
+
+    @classmethod
+    def get_answer_slice(cls, question_id, question_ids, session=DBSession):
+        """Returns (user_id, question_id, answer, respondents) rows for every
+        answer to question_id or question_ids given by a user who has also
+        answered question_id, where respondents is the total number of
+        answers to that row's question"""
+        table = cls.__table__
+        answers = sa.select([
+            table.c.user_id,
+            table.c.question_id,
+            table.c.answer,
+            sa.func.count(table.c.id).over(
+                partition_by=table.c.question_id).label('respondents')
+        ]).where(table.c.question_id.in_(list(question_ids) + [question_id])
+                 ).alias('answers')
+        target = table.alias('target')
+        return session.execute(sa.select([answers]).select_from(
+            answers.join(target, sa.and_(
+                target.c.user_id == answers.c.user_id,
+                target.c.question_id == question_id)))).fetchall()
+
 
 # -Views-
 @view_config(route_name="login", renderer="templates/gatepage.jinja2")
@@ -135,6 +324,9 @@ def login_page(request):
             authenticated = login(request)
         except ValueError as e:
             return {'error': e}
+        except PasswordPoolBusy as e:
+            request.response.status_int = 503
+            return {'error': e}
         if authenticated:
             headers = remember(request, username)
             return HTTPFound(request.route_url('home'), headers=headers)
@@ -149,19 +341,11 @@ def new_account_page(request):
     error = ""
     if request.method == "POST":
         try:
-            params = {
-                'secret': '6Lfq1gkTAAAAADReh88NQ4TggHTEnLEONl1oCcn_',
-                'response': request.params.get('g-recaptcha-response')
-            }
-            data = urllib.urlencode(params)
-            response = urllib2.Request(
-                url='https://www.google.com/recaptcha/api/siteverify',
-                data=data
+            human = CAPTCHA.verify(
+                request.params.get('g-recaptcha-response'),
+                request.client_addr
             )
-            f = urllib2.urlopen(response)
-            body = f.read()
-            api_data = json.loads(body)
-            if api_data['success']:
+            if human:
                 try:
                     username = request.params.get('username', None)
                     passsword = request.params.get('password', None)
@@ -171,11 +355,17 @@ def new_account_page(request):
                     User.new(username, passsword)
                     headers = remember(request, username)
                     return HTTPFound(request.route_url('home'), headers=headers)
+                except PasswordPoolBusy as e:
+                    request.response.status_int = 503
+                    return {'error': e}
                 except Exception as e:
                     error = e
                     return {'error': error}
             else:
                 return {'error': 'Are you a human?'}
+        except CaptchaUnavailable:
+            request.response.status_int = 503
+            return {'error': 'Could not check the captcha, try again later'}
         except Exception as e:
             return {'error': e}
     return {'error': error}
@@ -186,12 +376,15 @@ def login(request):
     password = request.params.get("password", None)
     if not (username and password):
         raise ValueError("Username and password are required")
-    manager = BCRYPTPasswordManager()
     try:
         user = User.get_by_username(username)
     except:
         raise ValueError("User does not exist")
-    return manager.check(user.password, password)
+    if not PASSWORDS.check(user.password, password):
+        return False
+    if ANSWERED is not None:
+        answered_bits(user.id)
+    return True
 
 
 @view_config(route_name="home", renderer='templates/homepage.jinja2')
@@ -208,80 +401,213 @@ def do_logout(request):
 @view_config(route_name="question", renderer='templates/questionpage.jinja2')
 def question(request):
     if request.authenticated_userid:
+        catch_up()
         user = User.get_by_username(request.authenticated_userid)
+        submitted = []
         if request.method == "POST":
             answer = request.params.get("answer")
             question = Question.get_question_by_id(
                 request.params.get("question_id")
             )
-            if (answer not in [None, ''] and question.id not in
-               [sub.question_id for sub in Submission.get_all_for_user(user)]):
+            if (answer not in [None, ''] and
+                    not Submission.exists(user, question)):
 
                 Submission.new(
                     user=user,
                     question=question,
                     answer=answer
                 )
-        questions = Question.all()
-        if questions:
-            submissions = Submission.get_all_for_user(user)
-            l = []
-            for q in questions:
-                if q.id not in [s.question_id for s in submissions]:
-                    l.append(q)
-            if l:
-                question = l[randint(0, len(l) - 1)]
-                x, u, y = make_data(question, user)
-                if x != [] and y != []:
-                    prediction = int(round(guess(x, u, y)))
-                else:
-                    prediction = "Not enough data to predict this question. Keep going!"
-                if 'HTTP_X_REQUESTED_WITH' in request.environ and request.method == "POST":
-                    return Response(
-                        body=json.dumps({"text": question.text,
-                                         "qid": question.id,
-                                         "prediction": prediction,
-                                         }), content_type=b'application/json')
-                return {"question": question, "prediction": prediction}
+                # the answered cache and the prediction state only hear
+                # about it after the commit
+                submitted.append((question.id, int(answer)))
+        question = Question.get_random_unanswered(
+            user, exclude=[q_id for q_id, a in submitted])
+        if question is not None:
+            prediction = PREDICTOR.predict(question.id, user.id, submitted)
+            if prediction is not None:
+                prediction = int(round(prediction))
+            else:
+                prediction = "Not enough data to predict this question. Keep going!"
+            if 'HTTP_X_REQUESTED_WITH' in request.environ and request.method == "POST":
+                return Response(
+                    body=json.dumps({"text": question.text,
+                                     "qid": question.id,
+                                     "prediction": prediction,
+                                     }), content_type=b'application/json')
+            return {"question": question, "prediction": prediction}
         return {"question": None, "prediction": None}
     else:
         return HTTPFound(request.route_url('home'))
 
 
+@view_config(route_name="predictions", renderer='json')
+def predictions(request):
+    if request.authenticated_userid:
+        catch_up()
+        user = User.get_by_username(request.authenticated_userid)
+        return {"predictions": [
+            {"qid": question.id, "text": question.text, "prediction": guess}
+            for question, guess in predict_all(user)
+        ]}
+    else:
+        return HTTPFound(request.route_url('home'))
+
+
+@view_config(route_name="stats", renderer='json')
+def stats(request):
+    return {
+        "prediction_cache": PREDICTOR.stats()
+        if isinstance(PREDICTOR, CachedPredictor) else None,
+        "write_behind": WRITER.stats() if WRITER is not None else None,
+        "answered_cache":
+            ANSWERED.stats() if ANSWERED is not None else None,
+    }
+
+
+@view_config(route_name="metrics")
+def metrics_page(request):
+    extra = []
+    if isinstance(PREDICTOR, CachedPredictor):
+        extra = [('prediction_cache_%s' % name, value)
+                 for name, value in sorted(PREDICTOR.stats().items())]
+    if WRITER is not None:
+        extra += [('write_behind_%s' % name, value)
+                  for name, value in sorted(WRITER.stats().items())]
+    if ANSWERED is not None:
+        extra += [('answered_cache_%s' % name, value)
+                  for name, value in sorted(ANSWERED.stats().items())]
+    return Response(body=metrics.METRICS.render(extra),
+                    content_type=b'text/plain')
+
+
 @view_config(route_name="about", renderer='templates/faqpage.jinja2')
 def faq(request):
     return {}
 
 
 def make_data(question, user):
-    """Gets data from the database and parses it for the Guess function"""
-    u, questions = _get_data(user, question)
-    users, questions = _select_users(u, questions)
-    x = _parse_into_matrix(questions, users)
-    y = []
-    for user_ in users:
-        y.append(Submission.get_answer(user_, question))
-    u = [sub.answer for sub in Submission.get_all_for_user(user)]
-    u = [Submission.get_answer(user, q) for q in questions]
+    """Gets data from the database and parses it for the Guess function.
+    Two queries are made however many users there are: one for the
+    user's own answers and one for every answer given by the users
+    that have answered the question. When the answer store is loaded
+    the data is sliced out of it instead"""
+    return _load_data(question.id, user.id)
+
+
+def _user_answers(user_id, pending=()):
+    """The user's (question_id, answer) pairs, including the ones still
+    waiting to be written behind and those in pending"""
+    own = Submission.get_user_answers(user_id, READ_SESSION)
+    if WRITER is not None:
+        own = list(own) + WRITER.pending_answers(user_id)
+    if pending:
+        own = list(own) + list(pending)
+    return own
+
+
+@metrics.timed('make_data')
+def _load_data(question_id, user_id, pending=()):
+    """make_data by question id and user id, with the (question_id,
+    answer) pairs in pending counted among the user's answers"""
+    if ANSWER_STORE.loaded:
+        questions = None
+        if QUESTION_STATS is not None and PREDICTOR_QUESTIONS:
+            questions = QUESTION_STATS.select(
+                question_id, ANSWER_STORE.user_answers(user_id, pending)[0],
+                PREDICTOR_QUESTIONS, MIN_RESPONDENTS)
+        return ANSWER_STORE.make_data(question_id, user_id, MIN_RESPONDENTS,
+                                      questions, pending)
+    own = _user_answers(user_id, pending)
+    rows = Submission.get_answer_slice(question_id, [q for q, a in own],
+                                       READ_SESSION)
+    return _pivot(question_id, own, rows)
+
+
+def _pivot(question_id, own, rows):
+    """Arranges the (question_id, answer) pairs of the user and the
+    (user_id, question_id, answer, respondents) rows of everyone else
+    into the x, u, y lists for the Guess function. Questions with fewer
+    than MIN_RESPONDENTS answers are left out and only the users that
+    answered every remaining question are kept"""
+    answers = {}
+    counts = {}
+    for user_id, q_id, answer, count in rows:
+        answers.setdefault(q_id, {})[user_id] = answer
+        counts[q_id] = count
+    if question_id not in answers:
+        return [], [], []
+    own = OrderedDict(own)
+    questions = [q_id for q_id in own
+                 if q_id != question_id and
+                 counts.get(q_id, 0) >= MIN_RESPONDENTS]
+    users = sorted(answers[question_id])
+    position = dict((user_id, i) for i, user_id in enumerate(users))
+    columns = np.zeros((len(questions) + 1, len(users)), dtype=np.uint8)
+    for i, q_id in enumerate([question_id] + questions):
+        columns[i, [position[user_id]
+                    for user_id in answers.get(q_id, {})]] = True
+    users = [users[i] for i in respondents(np.packbits(columns, axis=1))]
+    x = [[answers[q_id][user_id] for user_id in users] for q_id in questions]
+    u = [own[q_id] for q_id in questions]
+    y = [answers[question_id][user_id] for user_id in users]
     return x, u, y
 
 
+def predict_all(user):
+    """Predicts the user's answer to every question they have not answered
+    in one go. Returns (question, prediction) pairs with the highest
+    predictions first and the questions without one last."""
+    questions = Question.get_unanswered(user)
+    guesses = PREDICTOR.predict_all([q.id for q in questions], user.id)
+    return sorted(((q, guesses[q.id]) for q in questions),
+                  key=lambda pair: (pair[1] is None, -(pair[1] or 0)))
+
+
+@metrics.timed('make_data')
+def _load_all_data(question_ids, user_id):
+    """Gets the x, u, y, mask data for predicting all of question_ids at
+    once, from the answer store when it is loaded or else with one query
+    for the user's answers and one for the answers to every question"""
+    if ANSWER_STORE.loaded:
+        return ANSWER_STORE.make_all_data(question_ids, user_id,
+                                          MIN_RESPONDENTS)
+    own = OrderedDict(_user_answers(user_id))
+    rows = np.array(Submission.get_question_answers(
+        list(own) + list(question_ids), READ_SESSION),
+        dtype=int).reshape(-1, 4)
+    counts = dict(zip(rows[:, 1], rows[:, 3]))
+    targets = set(question_ids)
+    questions = [q_id for q_id in own if q_id not in targets and
+                 counts.get(q_id, 0) >= MIN_RESPONDENTS]
+    columns = dict((q_id, i) for i, q_id in
+                   enumerate(questions + list(question_ids)))
+    users, rows[:, 0] = np.unique(rows[:, 0], return_inverse=True)
+    rows[:, 1] = [columns.get(q_id, -1) for q_id in rows[:, 1]]
+    rows = rows[rows[:, 1] >= 0]
+    answers = np.zeros((len(users), len(columns)))
+    mask = np.zeros((len(users), len(columns)), dtype=bool)
+    answers[rows[:, 0], rows[:, 1]] = rows[:, 2]
+    mask[rows[:, 0], rows[:, 1]] = True
+    k = len(questions)
+    users = mask[:, :k].all(axis=1)
+    return (answers[users, :k], [own[q_id] for q_id in questions],
+            answers[users, k:], mask[users, k:])
+
+
 def _select_users(u, questions):
-    _u = [u.pop()]
-    _q = []
-    while u:
-        item = u.pop()
-        qu = questions.pop()
-        if len(item) >= 10:
-            _u.append(item)
-            _q.append(qu)
-
-    users = _u[0]
-    for item in _u:
-            users = list(
-                set(users) & set(item)
-            )
-    return users, _q[::-1]
+    """Keeps the questions that at least MIN_RESPONDENTS users answered
+    and finds the users that answered all of them and the current
+    question, whose users are the last list in u"""
+    users = OrderedDict((user.id, user) for item in u for user in item)
+    position = dict((user_id, i) for i, user_id in enumerate(users))
+    kept = [i for i, item in enumerate(u[:-1])
+            if len(item) >= MIN_RESPONDENTS]
+    columns = np.zeros((len(kept) + 1, len(users)), dtype=np.uint8)
+    for row, i in enumerate([len(u) - 1] + kept):
+        columns[row, [position[user.id] for user in u[i]]] = True
+    users = list(users.values())
+    selected = respondents(np.packbits(columns, axis=1))
+    return [users[i] for i in selected], [questions[i] for i in kept]
 
 
 def _get_data(user, question):
@@ -313,6 +639,7 @@ def _parse_into_matrix(questions, users):
     return x
 
 
+@metrics.timed('guess')
 def guess(every_answer, user_answers, cur_question):
     n = len(every_answer[0])
     for each in every_answer:
@@ -332,15 +659,306 @@ def guess(every_answer, user_answers, cur_question):
     return total
 
 
+def answered_bits(user_id):
+    """The questions a user has answered as an AnsweredSets int, read from
+    the database when the user is not cached"""
+    bits = ANSWERED.get(user_id)
+    if bits is None:
+        answered = Submission.get_answered_ids(user_id)
+        if WRITER is not None:
+            answered += [question_id for question_id, _
+                         in WRITER.pending_answers(user_id)]
+        bits = ANSWERED.load(user_id, answered)
+    return bits
+
+
+def _submitted(success, user_id, question_id, answer):
+    """Passes a committed submission on to the in-memory prediction state"""
+    if success:
+        _apply(user_id, question_id, answer)
+        _bump_generation()
+
+
+def _apply(user_id, question_id, answer):
+    if ANSWERED is not None:
+        ANSWERED.add(user_id, question_id)
+    for listener in SUBMISSION_LISTENERS:
+        listener(user_id, question_id, int(answer))
+
+
+def _bump_generation():
+    if GENERATION is not None:
+        GENERATION.bump()
+
+
+def catch_up():
+    """Applies the answers other workers of a pre-fork server have stored
+    since this one last looked, when the shared generation says there are
+    any. Besides the answer store this keeps the answered cache and the
+    prediction cache of the worker up to date, so it is needed without
+    the store too. Answers written behind reach the other workers once
+    their batch is written."""
+    global SEEN_GENERATION, REPLAYED_ID
+    if GENERATION is None:
+        return
+    generation = GENERATION.value
+    if generation == SEEN_GENERATION:
+        return
+    with CATCH_UP_LOCK:
+        rows = Submission.get_answers_since(
+            max(REPLAYED_ID - REPLAY_OVERLAP, 0))
+        for id, user_id, question_id, answer in rows:
+            REPLAYED_ID = max(REPLAYED_ID, id)
+            # skips the answers read in the overlap before, and with the
+            # store this worker's own answers, which are already in it
+            if id in REPLAYED_RECENTLY or (
+                    ANSWER_STORE.loaded and
+                    ANSWER_STORE.get(user_id, question_id) is not None):
+                continue
+            _apply(user_id, question_id, answer)
+            REPLAYED_RECENTLY.add(id)
+        for id in [id for id in REPLAYED_RECENTLY
+                   if id <= REPLAYED_ID - REPLAY_OVERLAP]:
+            REPLAYED_RECENTLY.discard(id)
+        SEEN_GENERATION = max(SEEN_GENERATION, generation)
+
+
+def configure_prediction(settings):
+    """Sets up the in-memory prediction state described by settings"""
+    global PREDICTOR, QUESTION_STATS, PREDICTOR_QUESTIONS, REPLAYED_ID
+    del SUBMISSION_LISTENERS[:]
+    REPLAYED_RECENTLY.clear()
+    if PREDICTOR is not None:
+        PREDICTOR.stop()
+    engine = settings.get('predictor', 'lstsq')
+    PREDICTOR_QUESTIONS = int(settings.get('predictor_questions', 0))
+    if engine in ('ridge', 'precomputed') or PREDICTOR_QUESTIONS:
+        QUESTION_STATS = QuestionStats(ANSWER_STORE)
+    else:
+        QUESTION_STATS = None
+    if engine == 'lstsq':
+        PREDICTOR = LstsqPredictor(_load_data, guess, _load_all_data)
+    elif engine == 'ridge':
+        PREDICTOR = RidgePredictor(
+            ANSWER_STORE,
+            alpha=float(settings.get('ridge_alpha', 0.1)),
+            minimum=MIN_RESPONDENTS,
+            stats=QUESTION_STATS
+        )
+    elif engine == 'precomputed':
+        PREDICTOR = PrecomputedPredictor(
+            ANSWER_STORE,
+            top=int(settings.get('model_predictors', 10)),
+            alpha=float(settings.get('ridge_alpha', 0.1)),
+            minimum=MIN_RESPONDENTS,
+            refresh_after=int(settings.get('model_refresh_after', 100)),
+            interval=float(settings.get('model_refresh_interval', 300)),
+            stats=QUESTION_STATS
+        )
+    elif engine == 'factorization':
+        PREDICTOR = FactorizationPredictor(
+            ANSWER_STORE,
+            rank=int(settings.get('factorization_rank', 8)),
+            iterations=int(settings.get('factorization_iterations', 10))
+        )
+    else:
+        raise ValueError("Unknown prediction engine: %s" % engine)
+    if int(settings.get('prediction_cache', 0)):
+        PREDICTOR = CachedPredictor(
+            PREDICTOR,
+            size=int(settings['prediction_cache']),
+            timeout=float(settings.get('prediction_cache_timeout', 300)),
+            staleness=int(settings.get('prediction_cache_staleness', 100))
+        )
+    # backends compare new answers against the store, so they are
+    # told about a submission before the store records it
+    SUBMISSION_LISTENERS.append(PREDICTOR.update)
+    if QUESTION_STATS is not None:
+        SUBMISSION_LISTENERS.append(QUESTION_STATS.update)
+    restored = []
+    if (settings.get('answer_store') or engine != 'lstsq' or
+            QUESTION_STATS is not None):
+        SUBMISSION_LISTENERS.append(ANSWER_STORE.add)
+        if settings.get('snapshot'):
+            restored = _warm_start(settings['snapshot'])
+        if not restored:
+            with transaction.manager:
+                rows = np.array(Submission.get_answers_since(0),
+                                dtype=np.int64).reshape(-1, 4)
+            ANSWER_STORE.load(rows[:, 1:])
+            REPLAYED_ID = int(rows[-1, 0]) if len(rows) else 0
+    else:
+        ANSWER_STORE.clear()
+        if GENERATION is not None:
+            # the answers up to here are already counted by the caches,
+            # which read them from the database
+            with transaction.manager:
+                REPLAYED_ID = Submission.get_last_id()
+                REPLAYED_RECENTLY.update(
+                    row[0] for row in Submission.get_answers_since(
+                        max(REPLAYED_ID - REPLAY_OVERLAP, 0)))
+    if QUESTION_STATS is not None and QUESTION_STATS not in restored:
+        QUESTION_STATS.fit()
+    if getattr(PREDICTOR, 'predictor', PREDICTOR) not in restored:
+        PREDICTOR.fit()
+
+
+def _warm_start(path):
+    """Restores what it can of the prediction state from the snapshot at
+    path and replays the answers submitted since it was taken. Returns
+    the restored objects, which need no fitting, or an empty list when
+    there is no usable snapshot."""
+    global REPLAYED_ID
+    try:
+        last_id, parts = snapshot.read(path)
+    except (IOError, OSError, ValueError, KeyError):
+        log.warning("Not starting from snapshot %s", path, exc_info=True)
+        return []
+    if 'store' not in parts:
+        return []
+    ANSWER_STORE.restore(parts['store'])
+    restored = [ANSWER_STORE]
+    if QUESTION_STATS is not None and 'stats' in parts:
+        QUESTION_STATS.restore(parts['stats'])
+        restored.append(QUESTION_STATS)
+    predictor = getattr(PREDICTOR, 'predictor', PREDICTOR)
+    if (isinstance(predictor, FactorizationPredictor) and
+            'factorization' in parts and
+            predictor.restore(parts['factorization'])):
+        restored.append(predictor)
+    with transaction.manager:
+        rows = Submission.get_answers_since(last_id)
+    for _, user_id, question_id, answer in rows:
+        _apply(user_id, question_id, answer)
+    REPLAYED_ID = rows[-1][0] if rows else last_id
+    return restored
+
+
+def configure_database(settings):
+    """Binds the sessions to engines built from settings. With a
+    read_database_url the prediction reads go to that replica through an
+    autocommit session, and so can miss the latest answers, including
+    one submitted earlier in the same request."""
+    global READ_SESSION
+    if not os.environ.get('TESTING', False):
+        engine = make_engine(DATABASE_URL, settings)
+        DBSession.configure(bind=engine)
+    metrics.instrument(DBSession.session_factory.kw.get('bind'))
+    if settings.get('read_database_url'):
+        engine = make_engine(settings['read_database_url'], settings)
+        metrics.instrument(engine)
+        READ_SESSION = scoped_session(
+            sessionmaker(bind=engine, autocommit=True))
+    else:
+        READ_SESSION = DBSession
+
+
+def configure_passwords(settings):
+    """Replaces the password pool with one built from settings"""
+    global PASSWORDS
+    PASSWORDS.close()
+    rounds = settings.get('bcrypt_rounds')
+    PASSWORDS = PasswordPool(
+        workers=int(settings.get('bcrypt_workers', 0)),
+        rounds=int(rounds) if rounds else None,
+        queue_size=int(settings.get('bcrypt_queue', 32)))
+
+
+def configure_captcha(settings):
+    """Replaces the captcha verifier with one built from settings"""
+    global CAPTCHA
+    CAPTCHA.close()
+    CAPTCHA = SiteVerifier(
+        url=settings.get('recaptcha_url', GOOGLE_URL),
+        secret=settings.get('recaptcha_secret', RECAPTCHA_SECRET),
+        timeout=float(settings.get('recaptcha_timeout', 3)))
+
+
+def configure_writer(settings):
+    """Starts writing submissions behind when settings ask for it,
+    stopping any writer already running"""
+    global WRITER
+    if WRITER is not None:
+        WRITER.stop()
+        WRITER = None
+    if int(settings.get('write_behind', 0)):
+        WRITER = SubmissionWriter(
+            DBSession.session_factory.kw['bind'],
+            Submission.__table__,
+            batch_size=int(settings.get('write_behind_batch', 500)),
+            interval=float(settings.get('write_behind_interval', 1.0)),
+            max_queue=int(settings.get('write_behind_queue', 10000)),
+            on_write=_bump_generation)
+        WRITER.start()
+
+
+def configure_answered(settings):
+    """Caches the questions answered by up to answered_cache users, or
+    stops caching them when that is 0"""
+    global ANSWERED
+    size = int(settings.get('answered_cache', 0))
+    ANSWERED = AnsweredSets(size) if size else None
+
+
 # -App-
-def app():
+def read_settings():
+    """Returns the app settings given by environment variables"""
     debug = os.environ.get('DEBUG', True)
     settings = {}
     settings['reload_all'] = debug
     settings['debug_all'] = debug
-    if not os.environ.get('TESTING', False):
-        engine = sa.create_engine(DATABASE_URL)
-        DBSession.configure(bind=engine)
+    settings['answer_store'] = os.environ.get('ANSWER_STORE', False)
+    settings['predictor'] = os.environ.get('PREDICTOR', 'lstsq')
+    settings['ridge_alpha'] = os.environ.get('RIDGE_ALPHA', 0.1)
+    settings['model_predictors'] = os.environ.get('MODEL_PREDICTORS', 10)
+    settings['model_refresh_after'] = os.environ.get(
+        'MODEL_REFRESH_AFTER', 100)
+    settings['model_refresh_interval'] = os.environ.get(
+        'MODEL_REFRESH_INTERVAL', 300)
+    settings['predictor_questions'] = os.environ.get('PREDICTOR_QUESTIONS', 0)
+    settings['snapshot'] = os.environ.get('SNAPSHOT')
+    settings['factorization_rank'] = os.environ.get('FACTORIZATION_RANK', 8)
+    settings['factorization_iterations'] = os.environ.get(
+        'FACTORIZATION_ITERATIONS', 10)
+    settings['prediction_cache'] = os.environ.get('PREDICTION_CACHE', 0)
+    settings['prediction_cache_timeout'] = os.environ.get(
+        'PREDICTION_CACHE_TIMEOUT', 300)
+    settings['prediction_cache_staleness'] = os.environ.get(
+        'PREDICTION_CACHE_STALENESS', 100)
+    settings['bcrypt_workers'] = os.environ.get('BCRYPT_WORKERS', 0)
+    settings['bcrypt_rounds'] = os.environ.get('BCRYPT_ROUNDS', None)
+    settings['bcrypt_queue'] = os.environ.get('BCRYPT_QUEUE', 32)
+    settings['recaptcha_url'] = os.environ.get('RECAPTCHA_URL', GOOGLE_URL)
+    settings['recaptcha_secret'] = os.environ.get(
+        'RECAPTCHA_SECRET', RECAPTCHA_SECRET)
+    settings['recaptcha_timeout'] = os.environ.get('RECAPTCHA_TIMEOUT', 3)
+    settings['read_database_url'] = os.environ.get('READ_DATABASE_URL')
+    settings['write_behind'] = os.environ.get('WRITE_BEHIND', 0)
+    settings['answered_cache'] = os.environ.get('ANSWERED_CACHE', 0)
+    settings['write_behind_batch'] = os.environ.get('WRITE_BEHIND_BATCH', 500)
+    settings['write_behind_interval'] = os.environ.get(
+        'WRITE_BEHIND_INTERVAL', 1.0)
+    settings['write_behind_queue'] = os.environ.get(
+        'WRITE_BEHIND_QUEUE', 10000)
+    settings.update(settings_from_env())
+    return settings
+
+
+def app(settings=None, preloaded=False):
+    """Builds the WSGI app from settings, read from the environment by
+    default. With preloaded the database and prediction state are taken
+    as already set up, by serve_prefork before it forked this process."""
+    if settings is None:
+        settings = read_settings()
+    if preloaded:
+        PREDICTOR.start()
+    else:
+        configure_database(settings)
+        configure_prediction(settings)
+    configure_passwords(settings)
+    configure_captcha(settings)
+    configure_writer(settings)
+    configure_answered(settings)
     auth_secret = os.environ.get('AUTH_SECRET', "testing")
     # and add a new value to the constructor for our Configurator:
     authn_policy = AuthTktAuthenticationPolicy(
@@ -355,24 +973,113 @@ def app():
     )
     config.include('pyramid_tm')
     config.include('pyramid_jinja2')
+    config.add_tween('metrics.metrics_tween_factory', under=INGRESS)
     config.add_static_view('static', os.path.join(HERE, 'static'))
     config.add_route('home', '/')
     config.add_route('new_account', '/new_account')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
     config.add_route('question', '/question')
+    config.add_route('predictions', '/predictions')
+    config.add_route('stats', '/stats')
+    config.add_route('metrics', '/metrics')
     config.add_route('about', '/about')
     config.scan()
     app = config.make_wsgi_app()
     return app
 
 
+def serve_prefork(workers, host='0.0.0.0', port=5000, threads=4):
+    """Serves the app from workers processes forked once the prediction
+    state is built. The workers share the pages of the answer store and
+    the fitted models, memory mapped from the snapshot or inherited from
+    this process, and only copy the pages their own updates touch. Each
+    worker catches up with the answers the others store whenever the
+    shared generation counter moves on."""
+    global GENERATION
+    settings = read_settings()
+    configure_database(settings)
+    GENERATION = prefork.Generation()
+    configure_prediction(settings)
+    # threads and pooled connections do not survive the fork
+    PREDICTOR.stop()
+    DBSession.remove()
+    for session in set([DBSession, READ_SESSION]):
+        session.session_factory.kw['bind'].dispose()
+    sock = prefork.listen(host, port)
+    prefork.serve(lambda: app(settings, preloaded=True), sock, workers,
+                  on_exit=_shutdown, host=host, port=port, threads=threads)
+
+
+def serve_single(host='0.0.0.0', port=5000, threads=4):
+    """Serves the app from this process until it gets SIGTERM or SIGINT,
+    then finishes the requests in progress, writes out the queued
+    submissions and stops background work"""
+    # as waitress.serve does
+    logging.basicConfig()
+    server = create_server(app(), host=host, port=port, threads=threads)
+    try:
+        prefork.run(server)
+    finally:
+        _shutdown()
+
+
+def _shutdown():
+    """Writes out queued submissions and stops background work"""
+    if WRITER is not None:
+        WRITER.stop()
+    PREDICTOR.stop()
+
+
 def init_db():
-    engine = sa.create_engine(DATABASE_URL)
+    engine = make_engine(DATABASE_URL)
     Base.metadata.create_all(engine)
+    upgrade_db(engine)
+
+
+def upgrade_db(engine):
+    """Brings an answers table created before it had constraints up to
+    date. Duplicate answers are removed keeping the first one given, as
+    are answers to users or questions that no longer exist, and then the
+    missing constraints and indexes are added. Safe to run repeatedly."""
+    table = Submission.__table__
+    users, questions = User.__table__, Question.__table__
+    with engine.begin() as connection:
+        inspector = sa.inspect(connection)
+        existing = set(c['name'] for c in
+                       inspector.get_unique_constraints(table.name))
+        existing.update(i['name'] for i in
+                        inspector.get_indexes(table.name))
+        existing.update(f['name'] for f in
+                        inspector.get_foreign_keys(table.name))
+
+        first = sa.select([sa.func.min(table.c.id)]).group_by(
+            table.c.user_id, table.c.question_id)
+        connection.execute(table.delete().where(~table.c.id.in_(first)))
+        connection.execute(table.delete().where(
+            ~table.c.user_id.in_(sa.select([users.c.id]))))
+        connection.execute(table.delete().where(
+            ~table.c.question_id.in_(sa.select([questions.c.id]))))
+
+        # superseded by the unique constraint
+        if 'ix_answers_user_id_question_id' in existing:
+            connection.execute('DROP INDEX ix_answers_user_id_question_id')
+        for constraint in table.constraints:
+            if (isinstance(constraint, (sa.UniqueConstraint,
+                                        sa.ForeignKeyConstraint)) and
+                    constraint.name not in existing):
+                connection.execute(sa.schema.AddConstraint(constraint))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
 
 
 if __name__ == '__main__':
-    app = app()
     port = os.environ.get('PORT', 5000)
-    serve(app, host='0.0.0.0', port=port)
+    workers = int(os.environ.get('WORKERS', 1))
+    if workers > 1:
+        serve_prefork(workers, port=int(port),
+                      threads=int(os.environ.get('THREADS', 4)))
+    else:
+        serve_single(port=int(port),
+                     threads=int(os.environ.get('THREADS', 4)))
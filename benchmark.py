@@ -0,0 +1,191 @@
+"""Benchmarks the /question hot path against synthetic populations.
+
+    python benchmark.py --database-url sqlite:///benchmark.db \\
+        --users 100 1000 --questions 100 --density 0.5 --output bench.json
+
+Every scale DROPS AND RECREATES the tables at --database-url, so point
+it at a scratch database. For each scale the time and number of queries
+of make_data, guess and a full /question POST are reported at the 50th
+and 99th percentiles, and everything is written to --output as JSON.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import sqlalchemy as sa
+import transaction
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+
+class QueryCounter(object):
+    """Counts the statements run by every engine"""
+
+    def __init__(self):
+        self.count = 0
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                        self._before)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.count += 1
+
+
+def populate(engine, users, questions, density, seed=0):
+    """Fills the database with users that answered each question with
+    probability density. Answers come from a few latent traits, so that
+    they correlate the way real ones do. The first user is the one the
+    benchmark logs in as and has answered nothing, and the second has
+    answered every other question."""
+    import app
+    from passwords import MANAGER
+    app.Base.metadata.drop_all(engine)
+    app.Base.metadata.create_all(engine)
+    rng = np.random.RandomState(seed)
+    traits = rng.randn(users, 3)
+    loadings = rng.randn(3, questions)
+    scores = traits.dot(loadings) + rng.randn(users, questions)
+    answers = np.clip(np.round(3 + scores), 1, 5).astype(int)
+    answered = rng.rand(users, questions) < density
+    answered[0] = False
+    answered[1] = np.arange(questions) % 2 == 0
+    hashed = unicode(MANAGER.encode(PASSWORD, 4))
+    with engine.begin() as connection:
+        connection.execute(app.User.__table__.insert(), [
+            {'id': i + 1, 'username': USERNAME if i == 0 else 'user%d' % i,
+             'password': hashed} for i in range(users)])
+        connection.execute(app.Question.__table__.insert(), [
+            {'id': i + 1, 'text': 'Question %d?' % i}
+            for i in range(questions)])
+        rows = np.argwhere(answered)
+        for start in range(0, len(rows), 10000):
+            connection.execute(app.Submission.__table__.insert(), [
+                {'user_id': int(u) + 1, 'question_id': int(q) + 1,
+                 'answer': int(answers[u, q])}
+                for u, q in rows[start:start + 10000]])
+    return answers
+
+
+def summarize(times, queries):
+    times = np.asarray(times) * 1000
+    return {
+        'samples': len(times),
+        'p50_ms': float(np.percentile(times, 50)) if len(times) else None,
+        'p99_ms': float(np.percentile(times, 99)) if len(times) else None,
+        'queries_p50': float(np.percentile(queries, 50)) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def measure(counter, function, *args):
+    """Returns the seconds and queries one call of function took, and its
+    result"""
+    before = counter.count
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, counter.count - before, result
+
+
+def run_scale(database_url, counter, users, questions, density, repeat,
+              seed):
+    """Benchmarks one population size"""
+    os.environ['DATABASE_URL'] = database_url
+    import app
+    from engines import make_engine
+    from webtest import TestApp
+    engine = make_engine(database_url)
+    answers = populate(engine, users, questions, density, seed)
+    testapp = TestApp(app.app())
+    testapp.post('/login', {'username': USERNAME, 'password': PASSWORD})
+
+    results = {'make_data': ([], []), 'guess': ([], []),
+               'question_post': ([], [])}
+    # measured as a user that has answered half the questions
+    with transaction.manager:
+        user = app.User.get_by_username('user1')
+        all_questions = app.Question.all()
+        for i in range(repeat):
+            question = all_questions[i % len(all_questions)]
+            seconds, queries, data = measure(
+                counter, app.make_data, question, user)
+            results['make_data'][0].append(seconds)
+            results['make_data'][1].append(queries)
+            x, u, y = data
+            if len(x) and len(y):
+                seconds, queries, _ = measure(
+                    counter, app.guess, [list(row) for row in x], list(u), y)
+                results['guess'][0].append(seconds)
+                results['guess'][1].append(queries)
+        question_ids = [q.id for q in all_questions[:repeat]]
+
+    for question_id in question_ids:
+        params = {'question_id': question_id,
+                  'answer': str(answers[0, question_id - 1])}
+        seconds, queries, _ = measure(
+            counter, testapp.post, '/question', params)
+        results['question_post'][0].append(seconds)
+        results['question_post'][1].append(queries)
+
+    app.configure_prediction({})
+    app.DBSession.remove()
+    engine.dispose()
+    return dict((name, summarize(times, queries))
+                for name, (times, queries) in results.items())
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'sqlite:///benchmark.db'))
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--questions', type=int, default=100)
+    parser.add_argument('--density', type=float, default=0.5)
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='calls timed per measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    counter = QueryCounter()
+    report = {
+        'revision': revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'database': sa.engine.url.make_url(args.database_url).drivername,
+        'questions': args.questions,
+        'density': args.density,
+        'repeat': args.repeat,
+        'scales': [],
+    }
+    for users in args.users:
+        results = run_scale(args.database_url, counter, users,
+                            args.questions, args.density, args.repeat,
+                            args.seed)
+        report['scales'].append({'users': users, 'results': results})
+        for name, summary in sorted(results.items()):
+            sys.stdout.write(
+                "%6d users  %-14s p50 %8.2fms  p99 %8.2fms  %s queries\n" % (
+                    users, name, summary['p50_ms'] or 0,
+                    summary['p99_ms'] or 0, summary['queries_p50']))
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,88 @@
+"""Removes duplicate answers, keeping the first one each user gave to a
+question.
+
+    python duplicatefixer.py [--dry-run] [--yes] [--batch-size N]
+"""
 from __future__ import unicode_literals
 
+import argparse
 import os
-from app import User, Submission
+import sys
+from engines import make_engine
+from app import Submission
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-if __name__ == '__main__':
-    engine = sa.create_engine(DATABASE_URL)
+
+def find_duplicates(session):
+    """Returns (id, user_id, question_id) for every answer that repeats an
+    earlier answer by the same user to the same question"""
+    ranked = session.query(
+        Submission.id,
+        Submission.user_id,
+        Submission.question_id,
+        sa.func.row_number().over(
+            partition_by=(Submission.user_id, Submission.question_id),
+            order_by=Submission.id).label('rank')
+    ).subquery()
+    return session.query(
+        ranked.c.id, ranked.c.user_id, ranked.c.question_id
+    ).filter(ranked.c.rank > 1).order_by(ranked.c.id).all()
+
+
+def delete_duplicates(session, ids, batch_size=1000, progress=None):
+    """Deletes the answers with the given ids batch_size at a time, calling
+    progress(deleted, total) after each batch. Returns the number deleted."""
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        deleted += session.query(Submission).filter(
+            Submission.id.in_(batch)).delete(synchronize_session=False)
+        if progress is not None:
+            progress(deleted, len(ids))
+    return deleted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the duplicates without deleting them')
+    parser.add_argument('--yes', action='store_true',
+                        help='commit without asking for confirmation')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='answers deleted per statement')
+    args = parser.parse_args(argv)
+
+    engine = make_engine(DATABASE_URL)
     session = sessionmaker(autoflush=True)
     session.configure(bind=engine)
     sess = session()
 
-    duplicates = []
-    users = User.all(sess)
-
-    while users:
-        user = users.pop()
-        submissions = Submission.get_all_for_user(user, sess)
-        while submissions:
-            currentsub = submissions[0]
-            for sub in submissions[1:]:
-                print "|================|"
-                print sub.id, sub.user_id, sub.question_id
-                print currentsub.id, currentsub.user_id, currentsub.question_id
-                if (sub.question_id, sub.user_id) == (currentsub.question_id,
-                                                      currentsub.user_id):
-                    duplicates.append(sub)
-                    submissions.remove(sub)
-                    raw_input("\n***Found***\n")
-            submissions.remove(currentsub)
-    raw_input(str(len(duplicates)) + " duplicates found")
-    if duplicates:
+    duplicates = find_duplicates(sess)
+    print len(duplicates), "duplicates found"
+    if args.dry_run:
         for sub in duplicates:
             print sub.id, sub.user_id, sub.question_id
-            sess.delete(
-                sess.query(Submission).filter(Submission.id == sub.id).one()
-            )
-        print "deleted"
-        if raw_input("Do you want to commit? (y/n)").lower() in ["y", "yes"]:
-            sess.commit()
-        else:
-            sess.rollback()
+        return
+    if not duplicates:
+        return
+
+    def progress(deleted, total):
+        sys.stdout.write("\rdeleted %d/%d" % (deleted, total))
+        sys.stdout.flush()
+
+    delete_duplicates(sess, [sub.id for sub in duplicates],
+                      args.batch_size, progress)
+    print
+    if args.yes or raw_input(
+            "Do you want to commit? (y/n)").lower() in ["y", "yes"]:
+        sess.commit()
+    else:
+        sess.rollback()
     print "done"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Builds the SQLAlchemy engines used by the app and the scripts"""
+import os
+
+import sqlalchemy as sa
+from pyramid.settings import asbool
+from sqlalchemy import exc
+
+ENVIRONMENT = {
+    'db_pool_size': ('DB_POOL_SIZE', 5),
+    'db_max_overflow': ('DB_MAX_OVERFLOW', 10),
+    'db_pool_timeout': ('DB_POOL_TIMEOUT', 30),
+    'db_pool_recycle': ('DB_POOL_RECYCLE', 3600),
+    'db_pre_ping': ('DB_PRE_PING', 'true'),
+    'db_statement_timeout': ('DB_STATEMENT_TIMEOUT', 0),
+}
+
+
+def settings_from_env():
+    """Returns the engine settings given by environment variables, with
+    the defaults filled in for the ones that are not set"""
+    return dict((name, os.environ.get(variable, default))
+                for name, (variable, default) in ENVIRONMENT.items())
+
+
+def _ping(connection, branch):
+    """Checks a connection is alive before it is used, reconnecting when
+    the server has dropped it"""
+    if branch:
+        return
+    should_close = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(sa.select([1]))
+    except exc.DBAPIError as e:
+        # the pool is invalidated along with the connection, so running
+        # the check again connects afresh
+        if e.connection_invalidated:
+            connection.scalar(sa.select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close
+
+
+def make_engine(url, settings=None):
+    """Creates an engine for url configured by the db_ settings, or by
+    the environment when no settings are given.
+
+    db_pool_size, db_max_overflow, db_pool_timeout and db_pool_recycle
+    size the connection pool, db_pre_ping tests connections before they
+    are handed out and db_statement_timeout (milliseconds, 0 for none)
+    makes PostgreSQL cancel statements that run for longer."""
+    if settings is None:
+        settings = settings_from_env()
+    defaults = settings_from_env()
+
+    def setting(name):
+        return settings.get(name, defaults[name])
+
+    url = sa.engine.url.make_url(url)
+    kwargs = {}
+    if url.get_backend_name() != 'sqlite':
+        kwargs.update(
+            pool_size=int(setting('db_pool_size')),
+            max_overflow=int(setting('db_max_overflow')),
+            pool_timeout=int(setting('db_pool_timeout')),
+            pool_recycle=int(setting('db_pool_recycle')),
+        )
+    timeout = int(setting('db_statement_timeout'))
+    if timeout and url.get_backend_name() == 'postgresql':
+        kwargs['connect_args'] = {
+            'options': '-c statement_timeout=%d' % timeout}
+    engine = sa.create_engine(url, **kwargs)
+    if asbool(setting('db_pre_ping')):
+        sa.event.listen(engine, 'engine_connect', _ping)
+    return engine
@@ -0,0 +1,204 @@
+"""Measures how well the prediction engines predict answers they have not
+seen.
+
+    python evaluate.py [--engines lstsq ridge ...] [--folds 5 | --loo]
+                       [--sample N] [--npz answers.npz] [--processes N]
+
+The answers, read from the database or from a long layout .npz written
+by export_answers.py, are split into folds. Each fold is held out in
+turn, the engine is fitted on the rest and asked to predict the answers
+held out. With --loo every sampled answer is its own fold. Folds are
+spread over a pool of processes, one per CPU by default.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import app
+from predictors import (LstsqPredictor, RidgePredictor, PrecomputedPredictor,
+                        FactorizationPredictor)
+from store import AnswerStore
+
+ENGINES = ['lstsq', 'ridge', 'precomputed', 'factorization']
+# answers shared with the worker processes, set before the pool forks
+ROWS = None
+
+
+def build(engine, store):
+    """Returns a fitted engine over the answers in store"""
+    if engine == 'lstsq':
+        def make_data(question_id, user_id, pending=()):
+            return store.make_data(question_id, user_id,
+                                   app.MIN_RESPONDENTS, pending=pending)
+        return LstsqPredictor(make_data, app.guess)
+    if engine == 'ridge':
+        predictor = RidgePredictor(store, minimum=app.MIN_RESPONDENTS)
+        predictor.fit()
+    elif engine == 'precomputed':
+        predictor = PrecomputedPredictor(store,
+                                         minimum=app.MIN_RESPONDENTS)
+        # fitted once here, without the background refreshes
+        predictor.refresh()
+    elif engine == 'factorization':
+        predictor = FactorizationPredictor(store)
+        predictor.fit()
+    else:
+        raise ValueError("Unknown engine %r" % engine)
+    return predictor
+
+
+def _evaluate(engine, held_out):
+    """Fits engine on every answer but the held out ones and predicts
+    those. Returns the answers, predictions (nan where the engine gave
+    none), seconds per prediction and seconds spent fitting."""
+    training = np.ones(len(ROWS), dtype=bool)
+    training[held_out] = False
+    store = AnswerStore()
+    store.load(ROWS[training])
+    start = time.time()
+    predictor = build(engine, store)
+    fitting = time.time() - start
+    answers, predictions, latencies = [], [], []
+    for user_id, question_id, answer in ROWS[held_out]:
+        start = time.time()
+        prediction = predictor.predict(int(question_id), int(user_id))
+        latencies.append(time.time() - start)
+        answers.append(answer)
+        predictions.append(np.nan if prediction is None else prediction)
+    return answers, predictions, latencies, fitting
+
+
+def _run(task):
+    """Evaluates an engine on some of the folds, adding up the results"""
+    engine, folds = task
+    answers, predictions, latencies, fitting = [], [], [], 0.0
+    for held_out in folds:
+        result = _evaluate(engine, held_out)
+        answers.extend(result[0])
+        predictions.extend(result[1])
+        latencies.extend(result[2])
+        fitting += result[3]
+    return engine, answers, predictions, latencies, fitting
+
+
+def _init(rows):
+    global ROWS
+    ROWS = rows
+
+
+def split(count, folds=5, loo=False, sample=None, seed=0):
+    """Returns lists of row indices, one per fold. With loo every index
+    is a fold of its own, and with sample only that many of the rows are
+    held out, chosen at random."""
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(count)
+    if sample:
+        order = order[:sample]
+    if loo:
+        return [order[i:i + 1] for i in range(len(order))]
+    return [order[i::folds] for i in range(folds)]
+
+
+def summarize(answers, predictions, latencies, fitting):
+    """Turns the answers and predictions of an engine into its scores"""
+    answers = np.asarray(answers, dtype=float)
+    predictions = np.asarray(predictions, dtype=float)
+    predicted = ~np.isnan(predictions)
+    errors = abs(predictions[predicted] - answers[predicted])
+    exact = np.round(predictions[predicted]) == answers[predicted]
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'held_out': len(answers),
+        'coverage': float(predicted.mean()) if len(answers) else 0.0,
+        'mae': float(errors.mean()) if len(errors) else None,
+        'exact_match': float(exact.mean()) if len(exact) else None,
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'fit_seconds': fitting,
+    }
+
+
+def evaluate(rows, engines, folds=5, loo=False, sample=None, seed=0,
+             processes=None):
+    """Cross validates each of engines over rows of (user_id, question_id,
+    answer) and returns their scores by engine"""
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    splits = split(len(rows), folds, loo, sample, seed)
+    # every process gets an even share of the folds of every engine
+    processes = processes or multiprocessing.cpu_count()
+    tasks = [(engine, splits[i::processes]) for engine in engines
+             for i in range(min(processes, len(splits)))]
+    if processes == 1:
+        _init(rows)
+        results = map(_run, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init, (rows,))
+        try:
+            results = pool.map(_run, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    combined = dict((engine, ([], [], [], 0.0)) for engine in engines)
+    for engine, answers, predictions, latencies, fitting in results:
+        total = combined[engine]
+        combined[engine] = (total[0] + answers, total[1] + predictions,
+                            total[2] + latencies, total[3] + fitting)
+    return dict((engine, summarize(*combined[engine])) for engine in engines)
+
+
+def load_rows(npz=None):
+    """Reads (user_id, question_id, answer) rows from a long layout .npz
+    or from the database"""
+    if npz:
+        data = np.load(npz)
+        return np.column_stack([data['user_id'], data['question_id'],
+                                data['answer']])
+    import transaction
+    from engines import make_engine
+    app.DBSession.configure(bind=make_engine(app.DATABASE_URL))
+    with transaction.manager:
+        return app.Submission.get_all_answers()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', choices=ENGINES,
+                        default=['lstsq'])
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--loo', action='store_true',
+                        help='hold out one answer at a time')
+    parser.add_argument('--sample', type=int,
+                        help='number of answers to hold out')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--npz', help='long layout export to read from')
+    parser.add_argument('--output', help='file to write the scores to')
+    args = parser.parse_args(argv)
+
+    rows = load_rows(args.npz)
+    scores = evaluate(rows, args.engines, args.folds, args.loo, args.sample,
+                      args.seed, args.processes)
+    for engine in args.engines:
+        score = scores[engine]
+        sys.stdout.write(
+            "%-14s MAE %s  exact %s  coverage %.2f  p50 %.2fms  "
+            "p99 %.2fms  fit %.1fs\n" % (
+                engine,
+                '%.3f' % score['mae'] if score['mae'] is not None else '-',
+                '%.3f' % score['exact_match']
+                if score['exact_match'] is not None else '-',
+                score['coverage'], score['latency_p50_ms'],
+                score['latency_p99_ms'], score['fit_seconds']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(scores, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Exports the answers table without loading it all into memory.
+
+    python export_answers.py OUTPUT [--layout long|wide] [--since-id N]
+
+OUTPUT ending in .npz is written as NumPy arrays, anything else as CSV.
+The long layout has a user_id, question_id, answer row per answer; the
+wide layout has a row per user with a column per question, holding 0
+where the user has not answered. With --since-id only the answers with
+a greater id are exported, and the highest id exported is printed so
+the next export can carry on from it.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+import sqlalchemy as sa
+from app import Submission
+from engines import make_engine
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+BATCH_SIZE = 10000
+
+
+def _select(since_id, *columns):
+    table = Submission.__table__
+    return sa.select(list(columns)).where(table.c.id > since_id)
+
+
+def stream_answers(connection, since_id=0, order_by='id',
+                   batch_size=BATCH_SIZE):
+    """Yields lists of (id, user_id, question_id, answer) rows, fetched
+    batch_size at a time through a server side cursor"""
+    table = Submission.__table__
+    query = _select(since_id, table.c.id, table.c.user_id,
+                    table.c.question_id, table.c.answer)
+    if order_by == 'id':
+        query = query.order_by(table.c.id)
+    else:
+        query = query.order_by(table.c.user_id, table.c.question_id)
+    result = connection.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+    result.close()
+
+
+def _ids(connection, since_id, column):
+    """Returns the sorted distinct ids in column of the answers exported"""
+    return [row[0] for row in connection.execute(
+        _select(since_id, column).distinct().order_by(column))]
+
+
+def _rows_by_user(batches):
+    """Groups streamed rows ordered by user into (user_id, rows) pairs"""
+    user_id, answers = None, []
+    for rows in batches:
+        for row in rows:
+            if row[1] != user_id:
+                if answers:
+                    yield user_id, answers
+                user_id, answers = row[1], []
+            answers.append(row)
+    if answers:
+        yield user_id, answers
+
+
+def export_long_csv(connection, output, since_id=0, batch_size=BATCH_SIZE):
+    """Writes id, user_id, question_id, answer rows to output. Returns the
+    number of rows and the highest id written."""
+    writer = csv.writer(output)
+    writer.writerow(['id', 'user_id', 'question_id', 'answer'])
+    count, last_id = 0, since_id
+    for rows in stream_answers(connection, since_id,
+                               batch_size=batch_size):
+        writer.writerows(rows)
+        count += len(rows)
+        last_id = rows[-1][0]
+    return count, last_id
+
+
+def export_wide_csv(connection, output, since_id=0, batch_size=BATCH_SIZE):
+    """Writes a user_id column followed by a column per question to
+    output. Returns the number of answers and the highest id written."""
+    table = Submission.__table__
+    question_ids = _ids(connection, since_id, table.c.question_id)
+    columns = dict((q, i) for i, q in enumerate(question_ids))
+    writer = csv.writer(output)
+    writer.writerow(['user_id'] + question_ids)
+    count, last_id = 0, since_id
+    batches = stream_answers(connection, since_id, 'user',
+                             batch_size=batch_size)
+    for user_id, rows in _rows_by_user(batches):
+        line = [0] * len(question_ids)
+        for id, _, question_id, answer in rows:
+            line[columns[question_id]] = answer
+            last_id = max(last_id, id)
+        writer.writerow([user_id] + line)
+        count += len(rows)
+    return count, last_id
+
+
+def _count(connection, since_id):
+    return connection.execute(_select(
+        since_id, sa.func.count(Submission.__table__.c.id))).scalar()
+
+
+def export_npz(connection, path, layout='long', since_id=0,
+               batch_size=BATCH_SIZE):
+    """Writes the answers to path as an uncompressed .npz. The long layout
+    has id, user_id, question_id and answer arrays; the wide layout has
+    user_ids, question_ids and an answers matrix with a row per user.
+    The arrays are filled on disk through memory maps, so memory use does
+    not grow with the table. Returns the number of answers and the
+    highest id written."""
+    table = Submission.__table__
+    directory = tempfile.mkdtemp()
+    try:
+        arrays = {}
+
+        def array(name, shape, dtype):
+            arrays[name] = np.lib.format.open_memmap(
+                os.path.join(directory, name + '.npy'), mode='w+',
+                dtype=dtype, shape=shape)
+            return arrays[name]
+
+        count, last_id = 0, since_id
+        if layout == 'long':
+            total = _count(connection, since_id)
+            ids = array('id', (total,), np.int64)
+            users = array('user_id', (total,), np.int64)
+            questions = array('question_id', (total,), np.int64)
+            answers = array('answer', (total,), np.int8)
+            for rows in stream_answers(connection, since_id,
+                                       batch_size=batch_size):
+                block = np.array(rows, dtype=np.int64)
+                end = count + len(block)
+                ids[count:end] = block[:, 0]
+                users[count:end] = block[:, 1]
+                questions[count:end] = block[:, 2]
+                answers[count:end] = block[:, 3]
+                count = end
+            if count:
+                last_id = int(ids[count - 1])
+        else:
+            user_ids = _ids(connection, since_id, table.c.user_id)
+            question_ids = _ids(connection, since_id, table.c.question_id)
+            array('user_ids', (len(user_ids),), np.int64)[:] = user_ids
+            array('question_ids', (len(question_ids),),
+                  np.int64)[:] = question_ids
+            matrix = array('answers', (len(user_ids), len(question_ids)),
+                           np.int8)
+            for rows in stream_answers(connection, since_id,
+                                       batch_size=batch_size):
+                block = np.array(rows, dtype=np.int64)
+                matrix[np.searchsorted(user_ids, block[:, 1]),
+                       np.searchsorted(question_ids, block[:, 2])] = \
+                    block[:, 3]
+                count += len(block)
+                last_id = max(last_id, int(block[:, 0].max()))
+        for name in arrays:
+            arrays[name].flush()
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as archive:
+            for name in sorted(os.listdir(directory)):
+                archive.write(os.path.join(directory, name), name)
+    finally:
+        shutil.rmtree(directory)
+    return count, last_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='.csv or .npz file, - for stdout')
+    parser.add_argument('--layout', choices=['long', 'wide'],
+                        default='long')
+    parser.add_argument('--since-id', type=int, default=0,
+                        help='only export answers with a greater id')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    engine = make_engine(DATABASE_URL)
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            # every query of an export has to see the same rows
+            connection = connection.execution_options(
+                isolation_level='REPEATABLE READ')
+        with connection.begin():
+            if args.output.endswith('.npz'):
+                count, last_id = export_npz(
+                    connection, args.output, args.layout, args.since_id,
+                    args.batch_size)
+            else:
+                export = {'long': export_long_csv,
+                          'wide': export_wide_csv}[args.layout]
+                if args.output == '-':
+                    count, last_id = export(connection, sys.stdout,
+                                            args.since_id, args.batch_size)
+                else:
+                    with open(args.output, 'wb') as output:
+                        count, last_id = export(
+                            connection, output, args.since_id,
+                            args.batch_size)
+    sys.stderr.write("exported %d answers, last id %d\n" % (count, last_id))
+
+
+if __name__ == '__main__':
+    main()
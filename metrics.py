@@ -0,0 +1,152 @@
+"""Per-request counts of SQL statements and time spent in the database
+and the prediction code"""
+import threading
+import time
+from functools import wraps
+
+import sqlalchemy as sa
+from pyramid.settings import asbool
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """What one request has done so far"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.db_time = 0.0
+        self.timers = {}
+
+
+class Metrics(object):
+    """Totals over every finished request, overall and per route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.queries = 0
+            self.max_queries = 0
+            self.db_time = 0.0
+            self.request_time = 0.0
+            self.timers = {}
+            self.routes = {}
+
+    def record(self, route, stats, elapsed):
+        with self.lock:
+            self.requests += 1
+            self.queries += stats.queries
+            self.max_queries = max(self.max_queries, stats.queries)
+            self.db_time += stats.db_time
+            self.request_time += elapsed
+            for name, seconds in stats.timers.items():
+                self.timers[name] = self.timers.get(name, 0.0) + seconds
+            counts = self.routes.setdefault(route, [0, 0])
+            counts[0] += 1
+            counts[1] += stats.queries
+
+    def render(self, extra=()):
+        """Returns the totals as lines of "name value" text, followed by
+        any extra (name, value) pairs"""
+        with self.lock:
+            lines = [
+                ('requests_total', self.requests),
+                ('queries_total', self.queries),
+                ('queries_per_request_max', self.max_queries),
+                ('db_seconds_total', self.db_time),
+                ('request_seconds_total', self.request_time),
+            ]
+            for name, seconds in sorted(self.timers.items()):
+                lines.append(('%s_seconds_total' % name, seconds))
+            for route, (requests, queries) in sorted(self.routes.items()):
+                lines.append(('requests_total{route="%s"}' % route,
+                              requests))
+                lines.append(('queries_total{route="%s"}' % route, queries))
+        lines.extend(extra)
+        return ''.join('%s %s\n' % line for line in lines)
+
+
+METRICS = Metrics()
+
+
+def current():
+    """Returns the RequestStats of the request being served by this
+    thread, or None outside of a request"""
+    return getattr(_local, 'stats', None)
+
+
+def timed(name):
+    """Decorator adding the time spent in a function to the current
+    request's timer called name"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = current()
+            if stats is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.timers[name] = (stats.timers.get(name, 0.0) +
+                                      time.time() - start)
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+    stats = current()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += time.time() - start
+
+
+def instrument(engine):
+    """Counts and times the statements run on engine. Connections that
+    were opened before this is called are not counted."""
+    if engine is None:
+        return
+    if not sa.event.contains(engine, 'before_cursor_execute',
+                             _before_cursor_execute):
+        sa.event.listen(engine, 'before_cursor_execute',
+                        _before_cursor_execute)
+        sa.event.listen(engine, 'after_cursor_execute',
+                        _after_cursor_execute)
+
+
+def metrics_tween_factory(handler, registry):
+    """Tracks each request and, in debug mode, reports what it did in
+    X-Query-Count, X-DB-Time and X-<Timer>-Time response headers"""
+    debug = asbool(registry.settings.get('debug_all', False))
+
+    def metrics_tween(request):
+        stats = _local.stats = RequestStats()
+        try:
+            response = handler(request)
+        finally:
+            _local.stats = None
+            elapsed = time.time() - stats.start
+            route = getattr(request.matched_route, 'name', None)
+            METRICS.record(route or 'other', stats, elapsed)
+        if debug:
+            response.headers['X-Query-Count'] = '%d' % stats.queries
+            response.headers['X-DB-Time'] = '%.6f' % stats.db_time
+            response.headers['X-Request-Time'] = '%.6f' % elapsed
+            for name, seconds in stats.timers.items():
+                header = 'X-%s-Time' % name.title().replace('_', '-')
+                response.headers[header] = '%.6f' % seconds
+        return response
+
+    return metrics_tween
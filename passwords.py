@@ -0,0 +1,63 @@
+"""bcrypt password hashing kept off the request threads"""
+import multiprocessing
+import threading
+
+from cryptacular.bcrypt import BCRYPTPasswordManager
+
+MANAGER = BCRYPTPasswordManager()
+
+
+class PasswordPoolBusy(Exception):
+    """Raised instead of queueing when too many hashes are in flight, or
+    when the pool takes longer than its timeout"""
+
+
+def _encode(password, rounds):
+    return MANAGER.encode(password, rounds)
+
+
+def _check(hashed, password):
+    return MANAGER.check(hashed, password)
+
+
+class PasswordPool(object):
+    """Hashes and checks passwords in a pool of worker processes, so that
+    bcrypt does not hold up the threads serving requests. At most
+    queue_size calls wait on the pool at once; any more raise
+    PasswordPoolBusy straight away, as do calls not done within timeout
+    seconds. With no workers the work is done in the calling thread."""
+
+    def __init__(self, workers=0, rounds=None, queue_size=32, timeout=30):
+        self.workers = workers
+        self.rounds = rounds
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.pool = multiprocessing.Pool(workers) if workers else None
+
+    def _run(self, function, *args):
+        if self.pool is None:
+            return function(*args)
+        if not self.slots.acquire(False):
+            raise PasswordPoolBusy("Too many password checks in progress")
+        try:
+            # get without a timeout cannot be interrupted on Python 2
+            return self.pool.apply_async(function, args).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            raise PasswordPoolBusy("Password check timed out")
+        finally:
+            self.slots.release()
+
+    def encode(self, password):
+        """Returns the bcrypt hash of password"""
+        return self._run(_encode, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Tells whether password matches the bcrypt hash"""
+        return self._run(_check, hashed, password)
+
+    def close(self):
+        """Shuts the worker processes down"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
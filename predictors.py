@@ -0,0 +1,611 @@
+"""Prediction backends for the question view"""
+import threading
+from collections import namedtuple
+
+import numpy as np
+from repoze.lru import ExpiringLRUCache
+
+from store import QuestionStats
+
+LOWEST = 1
+HIGHEST = 5
+CHUNK = 4096
+_MISSING = object()
+
+
+def clamp(prediction):
+    """Keeps a prediction inside the range of possible answers"""
+    return min(max(prediction, LOWEST), HIGHEST)
+
+
+class Predictor(object):
+    """Interface of the prediction backends. predict returns the answer a
+    user is expected to give to a question, or None when there is not
+    enough data to say. pending holds (question_id, answer) pairs of the
+    user that the backend has not been told about yet, such as an answer
+    submitted in a transaction that has not been committed."""
+
+    def predict(self, question_id, user_id, pending=()):
+        raise NotImplementedError
+
+    def predict_all(self, question_ids, user_id):
+        """Predicts several questions for a user, returning a dict of
+        question id to prediction. Backends override this when the
+        questions can share their work."""
+        return dict((question_id, self.predict(question_id, user_id))
+                    for question_id in question_ids)
+
+    def update(self, user_id, question_id, answer):
+        """Called with every submission once it has been committed"""
+
+    def fit(self):
+        """Builds whatever the backend needs before it can predict"""
+
+    def start(self):
+        """Restarts background work after stop, for instance in a process
+        forked from the one that fitted the backend"""
+
+    def stop(self):
+        """Stops any background work the backend started"""
+
+
+class CachedPredictor(Predictor):
+    """Remembers the predictions of another backend.
+
+    Predictions are keyed by question, user, the version of that user's
+    answers and the version of everyone's data. The user's version moves
+    on with each of their submissions and the global one every staleness
+    submissions, on bump(), or when the backend's own version changes.
+    Entries under old versions are never looked up again and simply age
+    out of the cache."""
+
+    def __init__(self, predictor, size=10000, timeout=300, staleness=100):
+        self.lock = threading.Lock()
+        self.predictor = predictor
+        self.cache = ExpiringLRUCache(size, default_timeout=timeout)
+        self.staleness = staleness
+        self.submissions = 0
+        self.version = 0
+        self.user_versions = {}
+
+    def bump(self):
+        """Moves on the global version, dropping every cached prediction"""
+        with self.lock:
+            self.version += 1
+
+    def key(self, question_id, user_id):
+        return (question_id, user_id, self.user_versions.get(user_id, 0),
+                self.version, getattr(self.predictor, 'version', 0))
+
+    def predict(self, question_id, user_id, pending=()):
+        # the user's version moves on once the pending answers are heard
+        # about, so a prediction from them would never be looked up
+        if pending:
+            return self.predictor.predict(question_id, user_id, pending)
+        key = self.key(question_id, user_id)
+        prediction = self.cache.get(key, _MISSING)
+        if prediction is _MISSING:
+            prediction = self.predictor.predict(question_id, user_id)
+            self.cache.put(key, prediction)
+        return prediction
+
+    def predict_all(self, question_ids, user_id):
+        predictions = {}
+        keys = {}
+        for question_id in question_ids:
+            keys[question_id] = self.key(question_id, user_id)
+            prediction = self.cache.get(keys[question_id], _MISSING)
+            if prediction is not _MISSING:
+                predictions[question_id] = prediction
+        missing = [q for q in question_ids if q not in predictions]
+        if missing:
+            for question_id, prediction in self.predictor.predict_all(
+                    missing, user_id).items():
+                self.cache.put(keys[question_id], prediction)
+                predictions[question_id] = prediction
+        return predictions
+
+    def update(self, user_id, question_id, answer):
+        with self.lock:
+            self.user_versions[user_id] = (
+                self.user_versions.get(user_id, 0) + 1)
+            self.submissions += 1
+            if self.submissions % self.staleness == 0:
+                self.version += 1
+        self.predictor.update(user_id, question_id, answer)
+
+    def fit(self):
+        self.predictor.fit()
+        self.bump()
+
+    def start(self):
+        self.predictor.start()
+
+    def stop(self):
+        self.predictor.stop()
+
+    def stats(self):
+        """Counters for sizing the cache"""
+        cache = self.cache
+        return {
+            'lookups': cache.lookups,
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'evictions': cache.evictions,
+            'entries': len(cache.data),
+            'size': cache.size,
+            'version': self.version,
+        }
+
+
+def lstsq_all(x, u, y, mask, chunk_size=1 << 20):
+    """Regresses every column of y on the columns of x plus a constant,
+    each over the rows where mask is set, and returns the predictions for
+    the answers u, with None where a column has no rows. The normal
+    equations of all the columns are built with matrix products over
+    blocks of rows, each holding the row outer products in at most
+    chunk_size values, and solved as one batch, with a vanishing ridge
+    term so that columns without a unique solution get close to the
+    least norm one lstsq would give."""
+    n, k = x.shape
+    a = np.hstack([x, np.ones((n, 1))])
+    m = mask.astype(float)
+    gram = np.zeros((m.shape[1], (k + 1) * (k + 1)))
+    step = max(chunk_size // ((k + 1) * (k + 1)), 1)
+    for start in range(0, n, step):
+        block = a[start:start + step]
+        outer = (block[:, :, np.newaxis] * block[:, np.newaxis, :]).reshape(
+            len(block), (k + 1) * (k + 1))
+        gram += m[start:start + step].T.dot(outer)
+    gram = gram.reshape(-1, k + 1, k + 1)
+    scale = gram.trace(axis1=1, axis2=2) / (k + 1) + 1
+    gram += 1e-10 * scale[:, np.newaxis, np.newaxis] * np.eye(k + 1)
+    beta = np.linalg.solve(gram, (m * y).T.dot(a))
+    predictions = beta.dot(np.append(u, 1))
+    return [clamp(prediction) if rows else None
+            for prediction, rows in zip(predictions, m.sum(axis=0))]
+
+
+class LstsqPredictor(Predictor):
+    """Fits a fresh least squares regression of the question on the
+    questions the user has answered for every prediction. Kept as the
+    reference the other backends are compared against. make_data is
+    called with the question id, the user id and the pending answers.
+    make_all_data, when given, loads the data for predict_all in one go
+    as (x, u, y, mask) for lstsq_all."""
+
+    def __init__(self, make_data, guess, make_all_data=None):
+        self.make_data = make_data
+        self.guess = guess
+        self.make_all_data = make_all_data
+
+    def predict(self, question_id, user_id, pending=()):
+        x, u, y = self.make_data(question_id, user_id, pending=pending)
+        if len(x) and len(y):
+            return self.guess(x, u, y)
+        return None
+
+    def predict_all(self, question_ids, user_id):
+        if self.make_all_data is None:
+            return super(LstsqPredictor, self).predict_all(question_ids,
+                                                           user_id)
+        question_ids = list(question_ids)
+        x, u, y, mask = self.make_all_data(question_ids, user_id)
+        if not len(u):
+            return dict((question_id, None) for question_id in question_ids)
+        return dict(zip(question_ids, lstsq_all(x, u, y, mask)))
+
+
+class RidgePredictor(Predictor):
+    """Ridge regression solved from pairwise sufficient statistics.
+
+    The counts, sums and cross-products kept by QuestionStats give the
+    covariances needed by the normal equations without touching the
+    individual answers, so a prediction costs O(k^3) for k answered
+    questions however many users there are. The statistics are kept up
+    to date by this backend unless a shared QuestionStats, maintained by
+    its owner, is passed in. Needs the answer store, and must hear about
+    a submission before the store does."""
+
+    def __init__(self, store, alpha=0.1, minimum=10, stats=None):
+        self.store = store
+        self.alpha = alpha
+        self.minimum = minimum
+        self.shared = stats is not None
+        self.stats = stats if self.shared else QuestionStats(store)
+        self.lock = self.stats.lock
+
+    index = property(lambda self: self.stats.index)
+    n = property(lambda self: self.stats.n)
+    s = property(lambda self: self.stats.s)
+    p = property(lambda self: self.stats.p)
+
+    def slots(self, question_ids):
+        """Maps question ids to their slots, -1 for the unknown ones"""
+        return self.stats.slots(question_ids)
+
+    def fit(self):
+        """Computes the statistics from everything in the answer store"""
+        if not self.shared:
+            self.stats.fit(CHUNK)
+
+    def update(self, user_id, question_id, answer):
+        """Adds the pairs a new answer forms with the user's other answers"""
+        if not self.shared:
+            self.stats.update(user_id, question_id, answer)
+
+    def covariance(self, slots, others=None):
+        """Pairwise covariances between the questions in the given slots
+        and those in others, or slots again, each taken over the users
+        that answered both"""
+        return self.stats.covariance(slots, others)
+
+    def predict(self, question_id, user_id, pending=()):
+        with self.lock:
+            t = self.slots([question_id])[0]
+            if t < 0 or not self.n[t, t]:
+                return None
+            questions, answers = self.store.user_answers(user_id, pending)
+            slots = self.slots(questions)
+            keep = (questions != question_id) & (slots >= 0)
+            keep[keep] = self.n[slots[keep], t] >= self.minimum
+            slots, answers = slots[keep], answers[keep]
+            if not len(slots):
+                return None
+            k = len(slots)
+            covariance = self.covariance(np.append(slots, t))
+            beta = np.linalg.solve(
+                covariance[:k, :k] + self.alpha * np.eye(k),
+                covariance[:k, k])
+            means = self.stats.means()
+        return clamp(means[t] + beta.dot(answers - means[slots]))
+
+    def predict_all(self, question_ids, user_id):
+        """Solves the normal equations once for every group of questions
+        that share the same usable predictors, with the covariances of
+        the whole group as the right hand side"""
+        question_ids = list(question_ids)
+        predictions = dict((question_id, None) for question_id in question_ids)
+        with self.lock:
+            targets = self.slots(question_ids)
+            known = targets >= 0
+            known[known] = self.n[targets[known], targets[known]] > 0
+            question_ids = np.array(question_ids, dtype=int)[known]
+            targets = targets[known]
+            questions, answers = self.store.user_answers(user_id)
+            if not len(questions):
+                return predictions
+            slots = self.slots(questions)
+            keep = (slots >= 0) & ~np.in1d(questions, question_ids)
+            slots, answers = slots[keep], answers[keep]
+            means = self.stats.means()
+            usable = self.n[np.ix_(slots, targets)] >= self.minimum
+            groups = {}
+            for i, column in enumerate(usable.T):
+                groups.setdefault(column.tobytes(), (column, []))[1].append(i)
+            for column, group in groups.values():
+                if not column.any():
+                    continue
+                k = column.sum()
+                beta = np.linalg.solve(
+                    self.covariance(slots[column]) + self.alpha * np.eye(k),
+                    self.covariance(slots[column], targets[group]))
+                estimates = means[targets[group]] + beta.T.dot(
+                    answers[column] - means[slots[column]])
+                for i, estimate in zip(group, estimates):
+                    predictions[int(question_ids[i])] = clamp(estimate)
+        return predictions
+
+
+Model = namedtuple('Model', 'version questions coefficients means intercept')
+
+
+class PrecomputedPredictor(Predictor):
+    """Serves predictions from a linear model fitted ahead of time for
+    every question, over the questions most correlated with it.
+
+    The models are fitted from the pairwise statistics of QuestionStats,
+    either a shared one kept up to date by its owner or one computed
+    afresh for every refresh. They are replaced all at once by a
+    background thread, every interval seconds or as soon as
+    refresh_after new submissions have come in. A prediction is a dot
+    product with the user's answers, where questions the user skipped
+    count as the average answer."""
+
+    def __init__(self, store, top=10, alpha=0.1, minimum=10,
+                 refresh_after=100, interval=300, stats=None):
+        self.lock = threading.Lock()
+        self.store = store
+        self.stats = stats
+        self.top = top
+        self.alpha = alpha
+        self.minimum = minimum
+        self.refresh_after = refresh_after
+        self.interval = interval
+        self.models = {}
+        self.version = 0
+        self.pending = 0
+        self.thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def refresh(self):
+        """Fits a new set of models and swaps them in"""
+        with self.lock:
+            self.pending = 0
+        if self.stats is None:
+            stats = QuestionStats(self.store)
+            stats.fit(CHUNK)
+        else:
+            stats = self.stats
+        with stats.lock:
+            question_ids = np.flatnonzero(stats.index >= 0)
+            slots = stats.index[question_ids]
+            covariance = stats.covariance(slots)
+            correlation = stats.correlation(slots)
+            overlap = stats.n[np.ix_(slots, slots)]
+            means = stats.means()[slots]
+        version = self.version + 1
+        models = {}
+        for t, question_id in enumerate(question_ids):
+            candidates = np.flatnonzero(overlap[:, t] >= self.minimum)
+            candidates = candidates[candidates != t]
+            order = np.argsort(-abs(correlation[candidates, t]))
+            candidates = candidates[order[:self.top]]
+            if not len(candidates):
+                continue
+            beta = np.linalg.solve(
+                covariance[np.ix_(candidates, candidates)] +
+                self.alpha * np.eye(len(candidates)),
+                covariance[candidates, t])
+            models[question_id] = Model(
+                version, question_ids[candidates], beta, means[candidates],
+                means[t] - beta.dot(means[candidates]))
+        self.models, self.version = models, version
+
+    def fit(self):
+        """Fits the first models and starts the background refreshes"""
+        self.refresh()
+        self.start()
+
+    def start(self):
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self.pending and not self._stop.is_set():
+                self.refresh()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def update(self, user_id, question_id, answer):
+        with self.lock:
+            self.pending += 1
+            if self.pending >= self.refresh_after:
+                self._wake.set()
+
+    def predict(self, question_id, user_id, pending=()):
+        model = self.models.get(question_id)
+        if model is None:
+            return None
+        with self.store.lock:
+            if user_id < self.store.shape[0]:
+                answered = self.store.mask[user_id, model.questions]
+                answers = self.store.answers[user_id, model.questions]
+            else:
+                answered = np.zeros(len(model.questions), dtype=bool)
+                answers = np.zeros(len(model.questions))
+        for pending_id, answer in pending:
+            given = model.questions == pending_id
+            answered = answered | given
+            answers = np.where(given, answer, answers)
+        if not answered.any():
+            return None
+        answers = np.where(answered, answers, model.means)
+        return clamp(model.intercept + model.coefficients.dot(answers))
+
+
+def _als_step(mask, residuals, factors, reg):
+    """Least squares factors for every row of residuals given the factors
+    of its columns, using only the answered cells. The per-row normal
+    equations are built with one matrix product per chunk and solved
+    together."""
+    rank = factors.shape[1]
+    outer = (factors[:, :, np.newaxis] * factors[:, np.newaxis, :]).reshape(
+        len(factors), rank * rank)
+    result = np.zeros((len(mask), rank))
+    for start in range(0, len(mask), CHUNK):
+        m = mask[start:start + CHUNK]
+        gram = m.dot(outer).reshape(len(m), rank, rank)
+        gram += (reg * np.maximum(m.sum(axis=1), 1)[:, np.newaxis, np.newaxis]
+                 * np.eye(rank))
+        result[start:start + CHUNK] = np.linalg.solve(
+            gram, residuals[start:start + CHUNK].dot(factors))
+    return result
+
+
+class FactorizationPredictor(Predictor):
+    """Low rank factorization of the answer matrix.
+
+    An answer is modelled as the average answer plus a user bias, a
+    question bias and the dot product of a user factor and a question
+    factor. Everything is fitted with alternating least squares over the
+    answered cells only, so users do not need to share any particular
+    set of answers with anyone. Every submission then re-solves the
+    submitting user's factor and takes a gradient step on the question's.
+    Factors are indexed by user id and question id like the store."""
+
+    def __init__(self, store, rank=8, reg=0.1, iterations=10, rate=0.02,
+                 seed=0):
+        self.lock = threading.RLock()
+        self.store = store
+        self.rank = rank
+        self.reg = reg
+        self.iterations = iterations
+        self.rate = rate
+        self.random = np.random.RandomState(seed)
+        self.total = 0.0
+        self.count = 0
+        self.user_bias = np.zeros(0)
+        self.question_bias = np.zeros(0)
+        self.users = np.zeros((0, rank))
+        self.questions = np.zeros((0, rank))
+
+    @property
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def _grow(self, users, questions):
+        """Makes room for the given numbers of user and question ids"""
+        if users > len(self.users):
+            self.user_bias = np.append(
+                self.user_bias, np.zeros(users - len(self.users)))
+            self.users = np.vstack(
+                [self.users, np.zeros((users - len(self.users), self.rank))])
+        if questions > len(self.questions):
+            added = questions - len(self.questions)
+            self.question_bias = np.append(self.question_bias,
+                                           np.zeros(added))
+            self.questions = np.vstack(
+                [self.questions,
+                 self.random.normal(0, 0.1, (added, self.rank))])
+
+    def fit(self):
+        """Fits the biases and factors to everything in the answer store"""
+        with self.store.lock:
+            user_ids = np.flatnonzero(self.store.mask.any(axis=1))
+            question_ids = np.flatnonzero(self.store.counts)
+            index = np.ix_(user_ids, question_ids)
+            mask = self.store.mask[index].astype(float)
+            answers = self.store.answers[index].astype(float)
+            shape = self.store.shape
+        with self.lock:
+            self.total, self.count = answers.sum(), int(mask.sum())
+            residuals = (answers - self.mean) * mask
+            question_bias = residuals.sum(axis=0) / (mask.sum(axis=0) +
+                                                     self.reg)
+            residuals -= question_bias * mask
+            user_bias = residuals.sum(axis=1) / (mask.sum(axis=1) + self.reg)
+            residuals -= user_bias[:, np.newaxis] * mask
+            questions = self.random.normal(0, 0.1,
+                                           (len(question_ids), self.rank))
+            for i in range(self.iterations):
+                users = _als_step(mask, residuals, questions, self.reg)
+                questions = _als_step(mask.T, residuals.T, users, self.reg)
+            self.user_bias = np.zeros(0)
+            self.question_bias = np.zeros(0)
+            self.users = np.zeros((0, self.rank))
+            self.questions = np.zeros((0, self.rank))
+            self._grow(*shape)
+            self.user_bias[user_ids] = user_bias
+            self.question_bias[question_ids] = question_bias
+            if len(user_ids) and len(question_ids):
+                self.users[user_ids] = users
+                self.questions[question_ids] = questions
+
+    def state(self):
+        """The fitted parameters, for snapshot.write"""
+        with self.lock:
+            return {'user_bias': self.user_bias,
+                    'question_bias': self.question_bias,
+                    'users': self.users, 'questions': self.questions,
+                    'totals': np.array([self.total, self.count])}
+
+    def restore(self, state):
+        """Takes over fitted parameters. Returns False, leaving the
+        predictor as it was, when they were fitted with another rank."""
+        if state['users'].shape[1] != self.rank:
+            return False
+        with self.lock:
+            self.user_bias = state['user_bias']
+            self.question_bias = state['question_bias']
+            self.users, self.questions = state['users'], state['questions']
+            self.total = float(state['totals'][0])
+            self.count = int(state['totals'][1])
+        return True
+
+    def _estimate(self, user_id, question_id):
+        return (self.mean + self.user_bias[user_id] +
+                self.question_bias[question_id] +
+                self.users[user_id].dot(self.questions[question_id]))
+
+    def _solve_user(self, questions, answers):
+        """The bias and factor of a user that best fit their answers to
+        questions, given the question biases and factors"""
+        residuals = answers - self.mean - self.question_bias[questions]
+        bias = residuals.sum() / (len(residuals) + self.reg)
+        factors = self.questions[questions]
+        return bias, np.linalg.solve(
+            factors.T.dot(factors) +
+            self.reg * len(questions) * np.eye(self.rank),
+            factors.T.dot(residuals - bias))
+
+    def update(self, user_id, question_id, answer):
+        with self.lock:
+            if self.store.get(user_id, question_id) is None:
+                self.total += answer
+                self.count += 1
+            self._grow(user_id + 1, question_id + 1)
+            error = answer - self._estimate(user_id, question_id)
+            self.question_bias[question_id] += self.rate * (
+                error - self.reg * self.question_bias[question_id])
+            self.questions[question_id] += self.rate * (
+                error * self.users[user_id] -
+                self.reg * self.questions[question_id])
+            questions, answers = self.store.user_answers(
+                user_id, [(question_id, answer)])
+            self.user_bias[user_id], self.users[user_id] = self._solve_user(
+                questions, answers.astype(float))
+
+    def predict(self, question_id, user_id, pending=()):
+        """With pending answers the user's factor is solved afresh from
+        them and the stored ones, as update would"""
+        with self.lock:
+            if (question_id >= len(self.questions) or
+                    not self.store.counts[question_id]):
+                return None
+            if pending:
+                questions, answers = self.store.user_answers(user_id,
+                                                             pending)
+                known = questions < len(self.questions)
+                if not known.any():
+                    return None
+                bias, factor = self._solve_user(
+                    questions[known], answers[known].astype(float))
+                return clamp(self.mean + bias +
+                             self.question_bias[question_id] +
+                             factor.dot(self.questions[question_id]))
+            if (user_id >= len(self.users) or
+                    not len(self.store.answered(user_id))):
+                return None
+            return clamp(self._estimate(user_id, question_id))
+
+    def predict_all(self, question_ids, user_id):
+        with self.lock:
+            if user_id >= len(self.users) or not len(
+                    self.store.answered(user_id)):
+                return dict((question_id, None)
+                            for question_id in question_ids)
+            question_ids = np.array(list(question_ids), dtype=int)
+            known = question_ids < len(self.questions)
+            known[known] = self.store.counts[question_ids[known]] > 0
+            estimates = (self.mean + self.user_bias[user_id] +
+                         self.question_bias[question_ids[known]] +
+                         self.questions[question_ids[known]].dot(
+                             self.users[user_id]))
+        predictions = dict((int(question_id), None) for question_id in
+                           question_ids[~known])
+        predictions.update((int(question_id), clamp(estimate)) for
+                           question_id, estimate in
+                           zip(question_ids[known], estimates))
+        return predictions
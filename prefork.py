@@ -0,0 +1,137 @@
+"""Pre-fork serving: worker processes forked from one parent, each running
+waitress on a listening socket the parent bound"""
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from waitress.adjustments import Adjustments
+from waitress.server import TcpWSGIServer
+
+
+class Generation(object):
+    """Counter in shared memory, made before forking, that any process
+    bumps to tell the others something has changed"""
+
+    def __init__(self):
+        self.shared = multiprocessing.Value('L', 0)
+
+    @property
+    def value(self):
+        return self.shared.value
+
+    def bump(self):
+        with self.shared.get_lock():
+            self.shared.value += 1
+
+
+class InheritedSocketServer(TcpWSGIServer):
+    """waitress server accepting on a socket that is already bound"""
+
+    def bind_server_socket(self):
+        pass
+
+
+def listen(host, port, backlog=1024):
+    """Binds the socket every worker accepts connections on"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(backlog)
+    return sock
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+def run(server):
+    """Runs a waitress server until the process gets SIGTERM or SIGINT,
+    then waits for the requests in progress. Unlike server.run, the
+    signals only set a flag: a SystemExit raised from the handler can be
+    swallowed by the catch-all handlers of waitress's channels, leaving
+    the process serving on."""
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping:
+        server.asyncore.loop(timeout=server.adj.asyncore_loop_timeout,
+                             map=server._map,
+                             use_poll=server.adj.asyncore_use_poll, count=1)
+    server.task_dispatcher.shutdown()
+
+
+def _work(make_app, sock, on_exit, adjustments):
+    # until run takes over, while the app is being made
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, _exit)
+    # as waitress.serve does
+    logging.basicConfig()
+    try:
+        run(InheritedSocketServer(make_app(), _sock=sock,
+                                  adj=Adjustments(**adjustments)))
+    finally:
+        if on_exit is not None:
+            on_exit()
+
+
+def serve(make_app, sock, workers, on_exit=None, **adjustments):
+    """Forks workers processes that each serve make_app() on sock with
+    the given waitress adjustments, replacing any that die, until the
+    parent gets SIGTERM or SIGINT. Each worker calls on_exit before it
+    exits."""
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _work(make_app, sock, on_exit, adjustments)
+            except SystemExit:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                # already exited, and about to be reaped
+                if e.errno != errno.ESRCH:
+                    raise
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        if not stopping:
+            # a worker failing on start would otherwise be respawned flat out
+            time.sleep(1)
+            spawn()
@@ -44,7 +44,8 @@ def displayhtml (public_key,
 def submit (recaptcha_challenge_field,
             recaptcha_response_field,
             private_key,
-            remoteip):
+            remoteip,
+            timeout = 10):
     """
     Submits a reCAPTCHA request for verification. Returns RecaptchaResponse
     for the request
@@ -53,6 +54,7 @@ def submit (recaptcha_challenge_field,
     recaptcha_response_field -- The value of recaptcha_response_field from the form
     private_key -- your reCAPTCHA private key
     remoteip -- the user's ip address
+    timeout -- seconds to wait for the verify server
     """
 
     if not (recaptcha_response_field and recaptcha_challenge_field and
@@ -81,7 +83,7 @@ def submit (recaptcha_challenge_field,
             }
         )
     
-    httpresp = urllib2.urlopen (request)
+    httpresp = urllib2.urlopen (request, timeout = timeout)
 
     return_values = httpresp.read ().splitlines ();
     httpresp.close();
@@ -0,0 +1,174 @@
+"""reCAPTCHA siteverify client with pooled keep-alive connections, and a
+stub siteverify server for tests and load tests.
+
+    python siteverify.py [port]
+
+runs the stub, which accepts every token except "fail".
+"""
+import BaseHTTPServer
+import httplib
+import json
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+GOOGLE_URL = 'https://www.google.com/recaptcha/api/siteverify'
+
+
+class CaptchaUnavailable(Exception):
+    """Raised when the siteverify endpoint cannot give an answer"""
+
+
+class SiteVerifier(object):
+    """Checks reCAPTCHA tokens against a siteverify endpoint. Up to
+    pool_size connections are kept open between calls. After failures
+    calls in a row have failed, calls fail straight away for reset_after
+    seconds before one is let through to try the endpoint again."""
+
+    def __init__(self, url=GOOGLE_URL, secret='', timeout=3.0, pool_size=4,
+                 failures=5, reset_after=30.0):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        self.secret = secret
+        self.timeout = timeout
+        self.connections = Queue.LifoQueue(pool_size)
+        self.failures = failures
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.opened_at = None
+
+    def _allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_after:
+                # let this call through to probe the endpoint
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def _record(self, success):
+        with self.lock:
+            if success:
+                self.failed = 0
+                self.opened_at = None
+            else:
+                self.failed += 1
+                if self.failed >= self.failures:
+                    self.opened_at = time.time()
+
+    def _request(self, connection, body):
+        try:
+            connection.request('POST', self.path, body, {
+                'Content-Type': 'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            raise
+
+    def _post(self, body):
+        try:
+            connection = self.connections.get_nowait()
+        except Queue.Empty:
+            connection = None
+        if connection is not None:
+            try:
+                status, data = self._request(connection, body)
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed the idle connection
+                connection = None
+        if connection is None:
+            connection = self.connection_class(self.host,
+                                               timeout=self.timeout)
+            status, data = self._request(connection, body)
+        if status != 200:
+            connection.close()
+            raise CaptchaUnavailable("siteverify returned %d" % status)
+        try:
+            self.connections.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+        return json.loads(data)
+
+    def verify(self, token, remoteip=None):
+        """Tells whether token is a valid reCAPTCHA response. Raises
+        CaptchaUnavailable when the endpoint cannot be asked."""
+        if not token:
+            return False
+        if not self._allow():
+            raise CaptchaUnavailable("siteverify is failing, not trying")
+        params = {'secret': self.secret, 'response': token}
+        if remoteip:
+            params['remoteip'] = remoteip
+        try:
+            result = self._post(urllib.urlencode(params))
+        except Exception as e:
+            self._record(False)
+            if isinstance(e, CaptchaUnavailable):
+                raise
+            raise CaptchaUnavailable(str(e))
+        self._record(True)
+        return bool(result.get('success'))
+
+    def close(self):
+        """Closes the pooled connections"""
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers siteverify requests, failing only the token "fail" """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = urlparse.parse_qs(self.rfile.read(length))
+        token = params.get('response', [''])[0]
+        body = json.dumps({'success': token not in ('', 'fail')})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http://%s:%d/recaptcha/api/siteverify' % self.server_address
+
+
+def start_stub(host='127.0.0.1', port=0):
+    """Serves the stub from a background thread and returns the server"""
+    server = StubServer((host, port), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8111
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    print "siteverify stub at", server.url
+    server.serve_forever()
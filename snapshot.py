@@ -0,0 +1,119 @@
+"""Snapshots of the in-memory prediction state, so that a new process can
+start from one instead of scanning the whole answers table.
+
+    python snapshot.py PATH [--factorization]
+
+A snapshot is a directory of .npy files, one per array of the answer
+store, the question statistics and, with --factorization, the fitted
+factorization model, along with the highest answer id it holds. PATH
+itself is a symlink to the latest snapshot directory and is swapped
+atomically, so a process reading it never sees half a snapshot. The
+answers are read in one transaction; an answer whose id was taken before
+that but committed after it is only picked up by the next snapshot.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from predictors import FactorizationPredictor
+from store import AnswerStore, QuestionStats
+
+VERSION = 1
+
+
+def write(path, parts, last_id):
+    """Writes parts, a dict of name to the state() of a component, as the
+    snapshot at path taken up to answer id last_id, replacing the one
+    that was there"""
+    path = os.path.abspath(path)
+    directory = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                 dir=os.path.dirname(path))
+    os.chmod(directory, 0o755)
+    for part, state in parts.items():
+        for name, array in state.items():
+            np.save(os.path.join(directory, '%s.%s.npy' % (part, name)),
+                    np.asarray(array))
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+        json.dump({'version': VERSION, 'last_id': last_id,
+                   'parts': sorted(parts), 'created': time.time()}, meta)
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    link = directory + '.link'
+    os.symlink(os.path.basename(directory), link)
+    os.rename(link, path)
+    # processes that already mapped the old files keep them until they
+    # exit, however they are removed
+    if previous is not None and previous != directory:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def read(path):
+    """Returns the last answer id and the parts of the snapshot at path,
+    with every array memory mapped copy-on-write: pages are shared
+    between processes until one of them changes them"""
+    directory = os.path.realpath(path)
+    with open(os.path.join(directory, 'meta.json')) as meta:
+        meta = json.load(meta)
+    if meta['version'] != VERSION:
+        raise ValueError("Snapshot version %r is not supported" %
+                         meta['version'])
+    parts = dict((part, {}) for part in meta['parts'])
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy'):
+            part, name, _ = filename.split('.')
+            parts[part][name] = np.load(os.path.join(directory, filename),
+                                        mmap_mode='c')
+    return meta['last_id'], parts
+
+
+def take(rows, rank=None, iterations=10):
+    """Builds the parts of a snapshot from (id, user_id, question_id,
+    answer) rows, fitting a factorization of rank when one is given.
+    Returns the parts and the highest id among the rows."""
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 4)
+    store = AnswerStore()
+    store.load(rows[:, 1:])
+    stats = QuestionStats(store)
+    stats.fit()
+    parts = {'store': store.state(), 'stats': stats.state()}
+    if rank:
+        predictor = FactorizationPredictor(store, rank=rank,
+                                           iterations=iterations)
+        predictor.fit()
+        parts['factorization'] = predictor.state()
+    return parts, int(rows[:, 0].max()) if len(rows) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='symlink to point at the snapshot')
+    parser.add_argument('--factorization', action='store_true',
+                        help='also fit and save the factorization model')
+    parser.add_argument('--rank', type=int, default=int(
+        os.environ.get('FACTORIZATION_RANK', 8)))
+    parser.add_argument('--iterations', type=int, default=int(
+        os.environ.get('FACTORIZATION_ITERATIONS', 10)))
+    args = parser.parse_args(argv)
+
+    import transaction
+    import app
+    from engines import make_engine
+    app.DBSession.configure(bind=make_engine(app.DATABASE_URL))
+    with transaction.manager:
+        rows = app.Submission.get_answers_since(0)
+    parts, last_id = take(rows, args.rank if args.factorization else None,
+                          args.iterations)
+    write(args.path, parts, last_id)
+    sys.stderr.write("snapshot of %d answers up to id %d written to %s\n" %
+                     (len(rows), last_id, args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""In-memory copy of the answers table for the prediction code"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from repoze.lru import LRUCache
+
+
+def respondents(bitsets):
+    """ANDs together a row of packed bits per question and returns the
+    positions of the bits left set, i.e. the users that answered every
+    one of the questions"""
+    # np.bitwise_and.reduce starts from 1 rather than all ones in the numpy
+    # versions we support, so the rows are ANDed one at a time
+    reduced = bitsets[0].copy()
+    for row in bitsets[1:]:
+        reduced &= row
+    words = np.flatnonzero(reduced)
+    bits = np.unpackbits(reduced[words]).reshape(-1, 8).view(bool)
+    return (words[:, np.newaxis] * 8 + np.arange(8))[bits]
+
+
+class AnswerStore(object):
+    """Dense user x question matrix of answers indexed directly by user id
+    and question id. mask marks the cells that have been answered, since
+    an unanswered cell holds 0 in answers. The answered cells of each
+    question are also kept as a row of packed bits in bits, and the
+    number of them in counts."""
+
+    def __init__(self, users=1024, questions=128):
+        self.lock = threading.RLock()
+        self.answers = np.zeros((users, questions), dtype=np.int8)
+        self.mask = np.zeros((users, questions), dtype=bool)
+        self.bits = np.zeros((questions, (users + 7) // 8), dtype=np.uint8)
+        self.counts = np.zeros(questions, dtype=int)
+        self.loaded = False
+
+    @property
+    def shape(self):
+        return self.answers.shape
+
+    def clear(self):
+        """Forgets every answer and marks the store as not loaded"""
+        with self.lock:
+            self.answers[:] = 0
+            self.mask[:] = False
+            self.bits[:] = 0
+            self.counts[:] = 0
+            self.loaded = False
+
+    def _grow(self, user_id, question_id):
+        """Doubles the matrix until user_id and question_id fit in it"""
+        users, questions = self.answers.shape
+        if user_id < users and question_id < questions:
+            return
+        while users <= user_id:
+            users *= 2
+        while questions <= question_id:
+            questions *= 2
+        old_users, old_questions = self.answers.shape
+        answers = np.zeros((users, questions), dtype=np.int8)
+        mask = np.zeros((users, questions), dtype=bool)
+        bits = np.zeros((questions, (users + 7) // 8), dtype=np.uint8)
+        counts = np.zeros(questions, dtype=int)
+        answers[:old_users, :old_questions] = self.answers
+        mask[:old_users, :old_questions] = self.mask
+        bits[:old_questions, :self.bits.shape[1]] = self.bits
+        counts[:old_questions] = self.counts
+        self.answers, self.mask = answers, mask
+        self.bits, self.counts = bits, counts
+
+    def load(self, rows):
+        """Replaces the contents of the store with the given
+        (user_id, question_id, answer) rows"""
+        rows = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+        with self.lock:
+            self.clear()
+            if len(rows):
+                self._grow(rows[:, 0].max(), rows[:, 1].max())
+                self.answers[rows[:, 0], rows[:, 1]] = rows[:, 2]
+                self.mask[rows[:, 0], rows[:, 1]] = True
+                self.bits[:] = np.packbits(self.mask.T.view(np.uint8),
+                                           axis=1)
+                self.counts[:] = self.mask.sum(axis=0)
+            self.loaded = True
+
+    def state(self):
+        """The arrays making up the store, for snapshot.write"""
+        with self.lock:
+            return {'answers': self.answers, 'mask': self.mask,
+                    'bits': self.bits, 'counts': self.counts}
+
+    def restore(self, state):
+        """Takes over the arrays of a state and marks the store loaded"""
+        with self.lock:
+            self.answers, self.mask = state['answers'], state['mask']
+            self.bits, self.counts = state['bits'], state['counts']
+            self.loaded = True
+
+    def add(self, user_id, question_id, answer):
+        """Records a single answer, growing the matrix when needed"""
+        with self.lock:
+            self._grow(user_id, question_id)
+            self.answers[user_id, question_id] = answer
+            if not self.mask[user_id, question_id]:
+                self.mask[user_id, question_id] = True
+                self.bits[question_id, user_id >> 3] |= 0x80 >> (user_id & 7)
+                self.counts[question_id] += 1
+
+    def get(self, user_id, question_id):
+        """Returns a user's answer to a question, or None if there is none"""
+        with self.lock:
+            users, questions = self.shape
+            if (user_id < users and question_id < questions and
+                    self.mask[user_id, question_id]):
+                return int(self.answers[user_id, question_id])
+            return None
+
+    def answered(self, user_id):
+        """Returns the ids of the questions a user has answered"""
+        with self.lock:
+            if user_id >= self.shape[0]:
+                return np.array([], dtype=int)
+            return np.flatnonzero(self.mask[user_id])
+
+    def user_answers(self, user_id, pending=()):
+        """Returns the ids of the questions a user has answered and the
+        answers given, both empty for a user the store has no row for.
+        pending holds (question_id, answer) pairs the store has not heard
+        about yet, which are added, in place of any stored answer to the
+        same question."""
+        with self.lock:
+            questions = self.answered(user_id)
+            if len(questions):
+                answers = self.answers[user_id, questions]
+            else:
+                answers = np.array([], dtype=np.int8)
+        if pending:
+            pending = OrderedDict(pending)
+            keep = ~np.in1d(questions, list(pending))
+            questions = np.append(questions[keep], list(pending)).astype(int)
+            answers = np.append(answers[keep], list(pending.values()))
+        return questions, answers
+
+    def make_data(self, question_id, user_id, minimum=10, questions=None,
+                  pending=()):
+        """Slices the matrix into the x, u, y data for the Guess function.
+        x has a row for every question the user answered that at least
+        minimum users have answered too, filled with the answers of the
+        users that answered all those questions and question_id. Passing
+        questions limits the rows to those of the user's questions.
+        pending is as in user_answers."""
+        with self.lock:
+            if question_id >= self.shape[1]:
+                return [], [], np.array([], dtype=int)
+            answered, answers = self.user_answers(user_id, pending)
+            own = dict(zip(answered, answers))
+            if questions is None:
+                questions = answered
+            questions = np.asarray(questions, dtype=int)
+            questions = questions[(questions != question_id) &
+                                  (questions < self.shape[1])]
+            questions = questions[self.counts[questions] >= minimum]
+            users = respondents(self.bits[np.append(question_id, questions)])
+            x = list(self.answers[np.ix_(users, questions)].T.astype(int))
+            u = [int(own[q]) for q in questions]
+            y = self.answers[users, question_id].astype(int)
+        return x, u, y
+
+    def make_all_data(self, question_ids, user_id, minimum=10):
+        """Slices the matrix into the x, u, y, mask data for lstsq_all.
+        x and u are as in make_data, but over the users that answered
+        all the questions the user answered, and y holds their answers to
+        every one of question_ids, where mask says which they gave."""
+        question_ids = np.asarray(question_ids, dtype=int)
+        with self.lock:
+            questions = self.answered(user_id)
+            questions = questions[~np.in1d(questions, question_ids)]
+            questions = questions[self.counts[questions] >= minimum]
+            if not len(questions):
+                users = np.array([], dtype=int)
+            else:
+                users = respondents(self.bits[questions])
+            targets = np.minimum(question_ids, self.shape[1] - 1)
+            outside = question_ids >= self.shape[1]
+            x = self.answers[np.ix_(users, questions)].astype(float)
+            u = [int(self.answers[user_id, q]) for q in questions]
+            y = self.answers[np.ix_(users, targets)].astype(float)
+            mask = self.mask[np.ix_(users, targets)]
+            mask[:, outside] = False
+        return x, u, y, mask
+
+
+class QuestionStats(object):
+    """Pairwise statistics of the answers in an AnswerStore.
+
+    For every pair of questions i, j and the users that answered both,
+    n holds how many there are and s, q and p the sums of their answers
+    to i, of the squares of those answers and of the products of their
+    answers to i and j. Covariances and correlations between questions
+    follow from these without going back to the individual answers, and
+    a new answer updates them in O(questions the user answered). Each
+    question gets a slot in the matrices when it is first answered and
+    index maps question ids to slots, with -1 for none. Must hear about
+    a submission before the store does."""
+
+    def __init__(self, store):
+        self.lock = threading.RLock()
+        self.store = store
+        self.index = np.zeros(0, dtype=int)
+        self.n = self.s = self.q = self.p = np.zeros((0, 0))
+
+    def slots(self, question_ids):
+        """Maps question ids to their slots, -1 for the unknown ones"""
+        question_ids = np.asarray(question_ids, dtype=int)
+        slots = -np.ones(len(question_ids), dtype=int)
+        known = question_ids < len(self.index)
+        slots[known] = self.index[question_ids[known]]
+        return slots
+
+    def _add_question(self, question_id):
+        """Gives a question the next free slot and returns it"""
+        if question_id >= len(self.index):
+            index = -np.ones(question_id + 1, dtype=int)
+            index[:len(self.index)] = self.index
+            self.index = index
+        slot = len(self.n)
+        self.index[question_id] = slot
+        for name in ('n', 's', 'q', 'p'):
+            grown = np.zeros((slot + 1, slot + 1))
+            grown[:slot, :slot] = getattr(self, name)
+            setattr(self, name, grown)
+        return slot
+
+    def fit(self, chunk=4096):
+        """Computes the statistics from everything in the store, chunk
+        users at a time"""
+        with self.lock:
+            with self.store.lock:
+                users, questions = self.store.shape
+                active = np.flatnonzero(self.store.counts)
+                index = -np.ones(questions, dtype=int)
+                index[active] = np.arange(len(active))
+                n, s, q, p = [np.zeros((len(active), len(active)))
+                              for i in range(4)]
+                for start in range(0, users, chunk):
+                    m = self.store.mask[start:start + chunk][:, active]
+                    if not m.any():
+                        continue
+                    m = m.astype(float)
+                    a = self.store.answers[start:start + chunk][:, active]
+                    a = a.astype(float)
+                    n += m.T.dot(m)
+                    s += a.T.dot(m)
+                    q += (a * a).T.dot(m)
+                    p += a.T.dot(a)
+            self.index, self.n, self.s, self.q, self.p = index, n, s, q, p
+
+    def state(self):
+        """The arrays making up the statistics, for snapshot.write"""
+        with self.lock:
+            return {'index': self.index, 'n': self.n, 's': self.s,
+                    'q': self.q, 'p': self.p}
+
+    def restore(self, state):
+        with self.lock:
+            self.index, self.n = state['index'], state['n']
+            self.s, self.q, self.p = state['s'], state['q'], state['p']
+
+    def update(self, user_id, question_id, answer):
+        """Adds the pairs a new answer forms with the user's other answers"""
+        with self.lock:
+            if self.store.get(user_id, question_id) is not None:
+                return
+            t = self.slots([question_id])[0]
+            if t < 0:
+                t = self._add_question(question_id)
+            questions, answers = self.store.user_answers(user_id)
+            answers = answers.astype(float)
+            slots = self.slots(questions)
+            answers = answers[slots >= 0]
+            slots = slots[slots >= 0]
+            self.n[t, slots] += 1
+            self.n[slots, t] += 1
+            self.s[t, slots] += answer
+            self.s[slots, t] += answers
+            self.q[t, slots] += answer * answer
+            self.q[slots, t] += answers * answers
+            self.p[t, slots] += answer * answers
+            self.p[slots, t] += answer * answers
+            self.n[t, t] += 1
+            self.s[t, t] += answer
+            self.q[t, t] += answer * answer
+            self.p[t, t] += answer * answer
+
+    def means(self):
+        """Average answer to the question in each slot"""
+        return self.s.diagonal() / np.maximum(self.n.diagonal(), 1)
+
+    def covariance(self, slots, others=None):
+        """Pairwise covariances between the questions in the given slots
+        and those in others, or slots again, each taken over the users
+        that answered both"""
+        if others is None:
+            others = slots
+        index = np.ix_(slots, others)
+        n = self.n[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = (self.p[index] - self.s[index] *
+                          self.s[np.ix_(others, slots)].T / n) / n
+        covariance[n == 0] = 0
+        return covariance
+
+    def correlation(self, slots, others=None):
+        """Pairwise correlations between the questions in the given slots
+        and those in others, or slots again, each taken over the users
+        that answered both. 0 where either question's answers to the
+        pair do not vary."""
+        if others is None:
+            others = slots
+        index = np.ix_(slots, others)
+        n = self.n[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.s[index] / n
+            other_mean = self.s[np.ix_(others, slots)].T / n
+            variance = self.q[index] / n - mean * mean
+            other_variance = (self.q[np.ix_(others, slots)].T / n -
+                              other_mean * other_mean)
+            correlation = ((self.p[index] / n - mean * other_mean) /
+                           np.sqrt(variance * other_variance))
+        correlation[~np.isfinite(correlation)] = 0
+        return correlation
+
+    def select(self, question_id, question_ids, top, minimum=10):
+        """Returns the top of question_ids most correlated, either way, with
+        question_id, out of those at least minimum users have answered
+        together with it"""
+        with self.lock:
+            t = self.slots([question_id])[0]
+            question_ids = np.asarray(question_ids, dtype=int)
+            if t < 0:
+                return question_ids[:0]
+            slots = self.slots(question_ids)
+            keep = (slots >= 0) & (question_ids != question_id)
+            keep[keep] = self.n[slots[keep], t] >= minimum
+            question_ids, slots = question_ids[keep], slots[keep]
+            strength = abs(self.correlation(slots, [t])[:, 0])
+        order = np.argsort(-strength, kind='mergesort')
+        return question_ids[order[:top]]
+
+
+class AnsweredSets(object):
+    """Remembers which questions each of the last size users seen has
+    answered, as an int with bit question_id set for every answer. Users
+    are loaded whole and kept up to date with add; a user that is not
+    cached gives None, for the caller to load them."""
+
+    def __init__(self, size=10000):
+        self.lock = threading.Lock()
+        self.cache = LRUCache(size)
+
+    def load(self, user_id, question_ids):
+        """Caches the questions a user has answered and returns the bits"""
+        bits = 0
+        for question_id in question_ids:
+            bits |= 1 << question_id
+        with self.lock:
+            self.cache.put(user_id, bits)
+        return bits
+
+    def get(self, user_id):
+        return self.cache.get(user_id)
+
+    def add(self, user_id, question_id):
+        """Marks a question answered for a user, if the user is cached"""
+        with self.lock:
+            bits = self.cache.get(user_id)
+            if bits is not None:
+                self.cache.put(user_id, bits | 1 << question_id)
+
+    def discard(self, user_id):
+        self.cache.invalidate(user_id)
+
+    def stats(self):
+        cache = self.cache
+        return {
+            'lookups': cache.lookups,
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'evictions': cache.evictions,
+            'entries': len(cache.data),
+            'size': cache.size,
+        }
+
+
+def set_bits(bits):
+    """Returns the positions of the bits set in an int, i.e. the question
+    ids in an AnsweredSets entry"""
+    return [question_id for question_id, bit
+            in enumerate(reversed(bin(bits)[2:])) if bit == '1']
@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 import os
 import pytest
 from pyramid import testing
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import IntegrityError
 from cryptacular.bcrypt import BCRYPTPasswordManager
 import sys
@@ -29,6 +29,7 @@ import app
 def connection(request):
     engine = create_engine(TEST_DATABASE_URL)
     app.Base.metadata.create_all(engine)
+    app.upgrade_db(engine)
     connection = engine.connect()
     app.DBSession.registry.clear()
     app.DBSession.configure(bind=connection)
@@ -678,3 +679,659 @@ def test_guess_unittest(suite, big_data):
     arg3 = [4 for i in range(98)]
 
     assert int(round(app.guess(arg1, arg2, arg3))) == prediction
+
+
+# Test 32
+# make_data fetches its data in a fixed number of queries
+def test_make_data_query_count(suite, big_data, connection):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        app.make_data(big_data['new_questions'][57], suite['new_user'])
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+    assert len(statements) == 2
+
+
+# Test 33
+# unit test for _pivot dropping questions with too few respondents
+def test_pivot_unittest():
+    own = [(1, 2), (2, 3), (3, 4)]
+    rows = [(u, 1, 5, 12) for u in (10, 11, 12)]
+    rows += [(u, 2, 1, 3) for u in (10, 11)]
+    rows += [(u, 3, 3, 10) for u in (10, 12)]
+    rows += [(u, 9, 4, 3) for u in (10, 11, 12)]
+
+    x, u, y = app._pivot(9, own, rows)
+
+    assert x == [[5, 5], [3, 3]]
+    assert u == [2, 4]
+    assert y == [4, 4]
+
+
+# Fixture 16
+# put the prediction state back to its defaults after the test
+@pytest.fixture(scope="function")
+def reset_prediction(request):
+    def cleanup():
+        app.configure_prediction({})
+
+    request.addfinalizer(cleanup)
+
+
+# Fixture 17
+# turn on the in-memory answer store
+@pytest.fixture(scope="function")
+def answer_store(reset_prediction, monkeypatch):
+    monkeypatch.setenv('ANSWER_STORE', 'True')
+    return app.ANSWER_STORE
+
+
+def logged_in_app():
+    """Logs in as the first user through a freshly configured app"""
+    from webtest import TestApp
+    testapp = TestApp(app.app())
+    params = {
+        'username': 'Test_Username',
+        'password': 'testpassword'
+    }
+    testapp.post('/login', params=params, status='3*')
+    return testapp
+
+
+def answer_first_questions(suite):
+    """Answers the first two questions through a freshly configured app,
+    returning the last response"""
+    testapp = logged_in_app()
+    for question in (suite['new_question'], suite['new_question2']):
+        params = {
+            'question_id': question.id,
+            'answer': '4'
+        }
+        response = testapp.post('/question', params=params, status='2*')
+    return response
+
+
+# Test 34
+# predictions are made from the answer store and submissions update it
+def test_submit_big_data_answer_store(suite, big_data, answer_store):
+    response = answer_first_questions(suite)
+    assert answer_store.loaded
+    assert 'Prediction: 4' in response.body
+    assert answer_store.answers[suite['new_user'].id,
+                                suite['new_question2'].id] == 4
+
+
+# Test 35
+# make_data does not touch the database when the answer store is loaded
+def test_make_data_answer_store(suite, big_data, answer_store, connection):
+    app.configure_prediction({'answer_store': True})
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        x, u, y = app.make_data(big_data['new_questions'][57],
+                                suite['new_user'])
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+    assert statements == []
+    assert len(x) == 50 and len(u) == 50 and len(y) == 98
+
+
+# Test 36
+# predictions can come from the ridge backend
+def test_submit_big_data_ridge(suite, big_data, answer_store, monkeypatch):
+    monkeypatch.setenv('PREDICTOR', 'ridge')
+    response = answer_first_questions(suite)
+    assert isinstance(app.PREDICTOR, app.RidgePredictor)
+    assert 'Prediction: 4' in response.body
+    slot = app.PREDICTOR.slots([suite['new_question2'].id])[0]
+    assert app.PREDICTOR.n[slot, slot] == 2
+
+
+# Test 37
+# predictions can come from precomputed models
+def test_submit_big_data_precomputed(suite, big_data, answer_store,
+                                     monkeypatch):
+    monkeypatch.setenv('PREDICTOR', 'precomputed')
+    response = answer_first_questions(suite)
+    assert isinstance(app.PREDICTOR, app.PrecomputedPredictor)
+    assert app.PREDICTOR.thread.is_alive()
+    assert 'Prediction: 4' in response.body
+
+
+# Test 38
+# predictions can come from the matrix factorization
+def test_submit_big_data_factorization(suite, big_data, answer_store,
+                                       monkeypatch):
+    monkeypatch.setenv('PREDICTOR', 'factorization')
+    response = answer_first_questions(suite)
+    assert isinstance(app.PREDICTOR, app.FactorizationPredictor)
+    assert 'Prediction: 4' in response.body
+
+
+# Test 39
+# predict every unanswered question at once from the database
+def test_predict_all_unittest(suite, big_data):
+    predictions = app.predict_all(suite['new_user'])
+    questions = [question for question, prediction in predictions]
+    assert len(questions) == 50
+    assert suite['new_question'] in questions
+    assert big_data['new_questions'][0] not in questions
+    assert [int(round(prediction)) for question, prediction
+            in predictions[:48]] == [4] * 48
+    assert [prediction for question, prediction
+            in predictions[48:]] == [None, None]
+
+
+# Test 40
+# the predictions endpoint returns the same from the answer store
+def test_predictions_view(suite, big_data, answer_store):
+    answer_first_questions(suite)
+    response = logged_in_app().get('/predictions', status='2*')
+    predictions = response.json['predictions']
+    assert len(predictions) == 48
+    assert set(int(round(p['prediction'])) for p in predictions) == set([4])
+    assert predictions[0]['text'].endswith('?')
+
+
+# Test 41
+# the predictions endpoint is only for logged in users
+def test_predictions_view_unauth(suite):
+    response = suite['testapp'].get('/predictions', status='3*')
+    assert response.status_code == 302
+
+
+# Test 42
+# predictions are cached and the cache counters can be read
+def test_prediction_cache(suite, big_data, reset_prediction, monkeypatch):
+    monkeypatch.setenv('PREDICTION_CACHE', '100')
+    testapp = logged_in_app()
+    assert isinstance(app.PREDICTOR, app.CachedPredictor)
+    testapp.get('/question', status='2*')
+    testapp.get('/predictions', status='2*')
+    stats = testapp.get('/stats', status='2*').json['prediction_cache']
+    assert stats['lookups'] == 51
+    assert stats['hits'] == 1
+
+
+# Test 43
+# unit test for picking a random unanswered question
+def test_get_random_unanswered_unittest(suite, big_data):
+    user = suite['new_user']
+    answered = set(submission.question_id for submission
+                   in big_data['new_submissions_for_user1'])
+    for i in range(5):
+        question = app.Question.get_random_unanswered(user)
+        assert question.id not in answered
+    unanswered = app.Question.get_unanswered(user)
+    assert len(unanswered) == 50
+    for question in unanswered:
+        app.Submission.new(user, question, 3)
+    assert app.Question.get_random_unanswered(user) is None
+    assert app.Submission.exists(user, unanswered[0])
+    assert not app.Submission.exists(suite['new_user2'], unanswered[-1])
+
+
+# Test 44
+# a user can only answer a question once
+def test_duplicate_answer_rejected(suite, db_session):
+    submission = app.Submission(user_id=suite['new_user2'].id,
+                                question_id=suite['new_question'].id,
+                                answer=2)
+    db_session.add(submission)
+    with pytest.raises(IntegrityError):
+        db_session.flush()
+
+
+# Test 45
+# answers must belong to an existing user and question once checked
+def test_orphan_answer_rejected(suite, db_session):
+    db_session.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    submission = app.Submission(user_id=suite['new_user'].id,
+                                question_id=-1, answer=2)
+    db_session.add(submission)
+    with pytest.raises(IntegrityError):
+        db_session.flush()
+
+
+# Test 46
+# upgrading an up to date database leaves its constraints alone
+def test_upgrade_db(connection):
+    from sqlalchemy import inspect
+    app.upgrade_db(connection.engine)
+    inspector = inspect(connection.engine)
+    assert [c['name'] for c in inspector.get_unique_constraints(
+        'answers')] == ['uq_answers_user_id_question_id']
+    assert 'ix_answers_question_id_user_id_answer' in [
+        i['name'] for i in inspector.get_indexes('answers')]
+    assert set(f['name'] for f in inspector.get_foreign_keys(
+        'answers')) == set(['fk_answers_user_id', 'fk_answers_question_id'])
+
+
+# Test 47
+# duplicatefixer finds repeated answers and deletes all but the first
+def test_duplicatefixer(suite, db_session):
+    import duplicatefixer
+    db_session.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    db_session.execute('ALTER TABLE answers '
+                       'DROP CONSTRAINT uq_answers_user_id_question_id')
+    user, question = suite['new_user2'], suite['new_question']
+    extra = [app.Submission(user_id=user.id, question_id=question.id,
+                            answer=answer) for answer in (1, 2, 3)]
+    db_session.add_all(extra)
+    db_session.flush()
+    duplicates = duplicatefixer.find_duplicates(db_session)
+    assert [d.id for d in duplicates] == [s.id for s in extra]
+    assert duplicates[0].user_id == user.id
+    calls = []
+    deleted = duplicatefixer.delete_duplicates(
+        db_session, [d.id for d in duplicates], batch_size=2,
+        progress=lambda done, total: calls.append((done, total)))
+    assert deleted == 3 and calls == [(2, 3), (3, 3)]
+    assert duplicatefixer.find_duplicates(db_session) == []
+    assert int(app.Submission.get_answer(user, question, db_session)) == 4
+
+
+# Test 48
+# importing questions skips blanks, repeats and questions already stored
+def test_import_questions(suite, db_session):
+    import add_question
+    lines = ["1?\n", "  \n", "new one? \n", b"bytes?\n", "new one?",
+             "2?", "last?"]
+    added, existing = add_question.import_questions(
+        lines, db_session, chunk_size=2)
+    assert added == ["new one?", "bytes?", "last?"]
+    assert existing == ["1?", "2?"]
+    texts = [q.text for q in app.Question.all(db_session)]
+    assert sorted(texts) == sorted(["1?", "2?"] + added)
+
+
+# Test 49
+# logging in is refused with a 503 while the password pool is saturated
+def test_login_password_pool_busy(suite, monkeypatch):
+    def busy(hashed, password):
+        raise app.PasswordPoolBusy("Too many password checks in progress")
+    monkeypatch.setattr(app.PASSWORDS, 'check', busy)
+    params = {'username': 'Test_Username', 'password': 'testpassword'}
+    response = suite['testapp'].post('/login', params=params, status=503)
+    assert 'Too many password checks' in response.body
+
+
+# Test 50
+# creating an account checks the captcha against the configured endpoint
+def test_create_user_with_stub_captcha(suite, monkeypatch):
+    from siteverify import SiteVerifier, start_stub
+    stub = start_stub()
+    try:
+        monkeypatch.setattr(app, 'CAPTCHA', SiteVerifier(stub.url))
+        params = {
+            'username': 'Test_Username_New',
+            'password': 'testpassword',
+            'confirm': 'testpassword',
+            'g-recaptcha-response': 'token'
+        }
+        suite['testapp'].post('/new_account', params=params, status=302)
+        assert app.User.get_by_username('Test_Username_New')
+        params['g-recaptcha-response'] = 'fail'
+        response = suite['testapp'].post('/new_account', params=params)
+        assert 'Are you a human?' in response.body
+    finally:
+        stub.shutdown()
+
+
+# Test 51
+# an unreachable captcha endpoint gives a 503 rather than hanging
+def test_create_user_captcha_unavailable(suite, monkeypatch):
+    from siteverify import CaptchaUnavailable
+
+    def unavailable(token, remoteip=None):
+        raise CaptchaUnavailable("timed out")
+    monkeypatch.setattr(app.CAPTCHA, 'verify', unavailable)
+    params = {'username': 'Test_Username_New', 'password': 'testpassword',
+              'confirm': 'testpassword', 'g-recaptcha-response': 'token'}
+    response = suite['testapp'].post('/new_account', params=params,
+                                     status=503)
+    assert 'try again later' in response.body
+
+
+# Test 52
+# debug responses say how many queries the request made and where the
+# time went, and the totals are served at /metrics
+def test_request_metrics(suite, big_data):
+    import metrics
+    answer_first_questions(suite)
+    testapp = logged_in_app()
+    metrics.METRICS.reset()
+    params = {'question_id': big_data['new_questions'][0].id, 'answer': '4'}
+    response = testapp.post('/question', params=params)
+    assert int(response.headers['X-Query-Count']) > 0
+    assert float(response.headers['X-DB-Time']) > 0
+    assert float(response.headers['X-Make-Data-Time']) > 0
+    text = testapp.get('/metrics').body
+    assert 'requests_total{route="question"} 1\n' in text
+    assert 'make_data_seconds_total' in text
+
+
+# Test 53
+# a read replica gets its own autocommit session for prediction reads
+def test_read_replica_session():
+    app.configure_database({'read_database_url': TEST_DATABASE_URL})
+    try:
+        assert app.READ_SESSION is not app.DBSession
+        assert app.READ_SESSION.scalar('select 1') == 1
+        assert app.READ_SESSION().autocommit
+    finally:
+        app.configure_database({})
+    assert app.READ_SESSION is app.DBSession
+
+
+# Test 54
+# prediction reads return plain rows without loading Submission objects
+# (98 users answered every question, the first user the first 50)
+def test_prediction_reads_skip_orm(suite, big_data, db_session):
+    db_session.expunge_all()
+    user = big_data['new_users'][0]
+    question_ids = [q.id for q in big_data['new_questions'][:3]]
+    own = app.Submission.get_user_answers(user.id, db_session)
+    rows = app.Submission.get_answer_slice(question_ids[0], question_ids,
+                                           db_session)
+    rows += app.Submission.get_question_answers(question_ids, db_session)
+    assert len(own) == 98 and own[0] == (big_data['new_questions'][0].id, 4)
+    assert len(rows) == 2 * 3 * 99
+    assert set(tuple(row)[2:] for row in rows) == set([(4, 99)])
+    assert len(db_session.identity_map) == 0
+
+
+# Test 55
+# answers export as long and wide CSV and as npz, optionally since an id
+def test_export_answers(suite, db_session, tmpdir):
+    import csv
+    import io
+    import numpy as np
+    import export_answers
+    connection = db_session.connection()
+    first, second = suite['new_submission'], suite['new_submission2']
+    user, questions = first.user_id, [first.question_id, second.question_id]
+
+    output = io.BytesIO()
+    count, last_id = export_answers.export_long_csv(connection, output,
+                                                    batch_size=1)
+    rows = list(csv.reader(io.BytesIO(output.getvalue())))
+    assert (count, last_id) == (2, second.id)
+    assert rows[1] == [str(first.id), str(user), str(questions[0]), '4']
+
+    output = io.BytesIO()
+    export_answers.export_wide_csv(connection, output)
+    rows = list(csv.reader(io.BytesIO(output.getvalue())))
+    assert rows == [['user_id'] + [str(q) for q in questions],
+                    [str(user), '4', '4']]
+
+    path = str(tmpdir.join('long.npz'))
+    count, last_id = export_answers.export_npz(
+        connection, path, since_id=first.id)
+    data = np.load(path)
+    assert (count, last_id) == (1, second.id)
+    assert list(data['question_id']) == [questions[1]]
+
+    path = str(tmpdir.join('wide.npz'))
+    export_answers.export_npz(connection, path, 'wide', batch_size=1)
+    data = np.load(path)
+    assert list(data['user_ids']) == [user]
+    assert list(data['question_ids']) == questions
+    assert data['answers'].tolist() == [[4, 4]]
+
+
+# Test 56
+# make_data keeps only the user's questions that best predict the target
+# when PREDICTOR_QUESTIONS is set, with the statistics kept up to date
+def test_make_data_predictor_questions(suite, big_data, reset_prediction):
+    app.configure_prediction({'predictor_questions': 5})
+    assert app.ANSWER_STORE.loaded
+    assert app.SUBMISSION_LISTENERS == [app.PREDICTOR.update,
+                                        app.QUESTION_STATS.update,
+                                        app.ANSWER_STORE.add]
+    x, u, y = app.make_data(big_data['new_questions'][57], suite['new_user'])
+    assert len(x) == 5 and len(u) == 5 and len(y) == 98
+    app.configure_prediction({})
+    assert app.QUESTION_STATS is None
+
+
+# Test 57
+# with write-behind an answer is queued, counts as answered straight away
+# and reaches the answers table when the writer flushes
+def test_write_behind(suite, connection, reset_prediction, monkeypatch):
+    from writer import SubmissionWriter
+    testapp = logged_in_app()
+    writer = SubmissionWriter(connection, app.Submission.__table__)
+    monkeypatch.setattr(app, 'WRITER', writer)
+    user, question = suite['new_user'], suite['new_question']
+    params = {'question_id': question.id, 'answer': '4'}
+    response = testapp.post('/question', params=params, status='2*')
+    assert writer.is_pending(user.id, question.id)
+    assert app.Submission.exists(user, question)
+    assert [q.id for q in app.Question.get_unanswered(user)] == [
+        suite['new_question2'].id]
+    assert "2?" in response.body
+    assert dict(app._user_answers(user.id)) == {question.id: 4}
+    stats = testapp.get('/stats', status='2*').json['write_behind']
+    assert stats['pending'] == 1 and stats['written'] == 0
+    assert 'write_behind_queue_depth 1' in testapp.get('/metrics').body
+
+    writer.flush()
+    assert not writer.is_pending(user.id, question.id)
+    assert app.Submission.get_user_answers(user.id) == [(question.id, 4)]
+    assert app.Submission.exists(user, question)
+
+
+# Test 58
+# with the answered cache the question view reads the user's answered
+# questions from memory once login has loaded them
+def test_answered_cache(suite, connection, reset_prediction, monkeypatch):
+    monkeypatch.setenv('ANSWERED_CACHE', '100')
+    # put back to None after the test even when it fails
+    monkeypatch.setattr(app, 'ANSWERED', None)
+    user, question = suite['new_user'], suite['new_question']
+    testapp = logged_in_app()
+    assert app.ANSWERED.get(user.id) == 0
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        params = {'question_id': question.id, 'answer': '4'}
+        response = testapp.post('/question', params=params, status='2*')
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+    assert "2?" in response.body
+    assert app.ANSWERED.get(user.id) == 1 << question.id
+    assert not [s for s in statements if 'EXISTS' in s]
+    # the question just answered is left out before the cache hears of it
+    app.ANSWERED.load(user.id, [])
+    for i in range(10):
+        assert app.Question.get_random_unanswered(
+            user, exclude=[question.id]).id == suite['new_question2'].id
+    app.ANSWERED.add(user.id, question.id)
+    assert app.Submission.exists(user, question)
+    assert [q.id for q in app.Question.get_unanswered(user)] == [
+        suite['new_question2'].id]
+    stats = testapp.get('/stats', status='2*').json['answered_cache']
+    assert stats['entries'] == 1
+    app.configure_answered({})
+    assert app.ANSWERED is None
+
+
+# Test 59
+# with a snapshot the prediction state starts from it and replays only
+# the answers submitted after it was taken
+def test_snapshot_warm_start(suite, big_data, reset_prediction, tmpdir,
+                             connection):
+    import snapshot
+    path = str(tmpdir.join('snapshot'))
+    rows = app.Submission.get_answers_since(0)
+    snapshot.write(path, *snapshot.take(rows[:-5]))
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        app.configure_prediction({'predictor': 'ridge', 'snapshot': path})
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+    assert len(statements) == 1 and 'answers.id >' in statements[0]
+    for _, user_id, question_id, answer in rows[-5:]:
+        assert app.ANSWER_STORE.get(user_id, question_id) == answer
+    restored = app.QUESTION_STATS
+    app.configure_prediction({'predictor': 'ridge'})
+    assert (restored.n == app.QUESTION_STATS.n).all()
+    assert abs(restored.p - app.QUESTION_STATS.p).max() < 1e-9
+
+    app.configure_prediction({'predictor': 'ridge',
+                              'snapshot': str(tmpdir.join('missing'))})
+    assert app.ANSWER_STORE.loaded
+
+
+# Test 60
+# a worker of a pre-fork server picks up the answers other workers stored
+# once the shared generation moves on, and its own answers only once
+def test_catch_up(suite, big_data, reset_prediction, db_session,
+                  monkeypatch):
+    import prefork
+    monkeypatch.setattr(app, 'GENERATION', prefork.Generation())
+    monkeypatch.setattr(app, 'SEEN_GENERATION', 0)
+    app.configure_prediction({'predictor': 'ridge'})
+    assert app.REPLAYED_ID == app.Submission.get_answers_since(0)[-1][0]
+    user, question = suite['new_user'], suite['new_question']
+    # stored by another worker
+    db_session.add(app.Submission(user_id=user.id, question_id=question.id,
+                                  answer=2))
+    db_session.flush()
+    app.catch_up()
+    assert app.ANSWER_STORE.get(user.id, question.id) is None
+    app.GENERATION.bump()
+    app.catch_up()
+    assert app.ANSWER_STORE.get(user.id, question.id) == 2
+    assert app.SEEN_GENERATION == 1
+    n = app.QUESTION_STATS.n.copy()
+    app.GENERATION.bump()
+    app.catch_up()
+    assert (app.QUESTION_STATS.n == n).all()
+
+    app.app(app.read_settings(), preloaded=True)
+    assert app.ANSWER_STORE.get(user.id, question.id) == 2
+
+
+# Test 61
+# a question nobody has answered yet is served without a prediction
+def test_question_without_answers(new_user, new_question, reset_prediction):
+    response = logged_in_app().get('/question', status='2*')
+    assert "1?" in response.body
+    assert "Not enough data" in response.body
+
+
+# Test 62
+# without the answer store, catching up keeps the answered cache of a
+# pre-fork worker current and applies each answer once
+def test_catch_up_answered_cache(suite, reset_prediction, db_session,
+                                 monkeypatch):
+    import prefork
+    monkeypatch.setattr(app, 'GENERATION', prefork.Generation())
+    monkeypatch.setattr(app, 'SEEN_GENERATION', 0)
+    monkeypatch.setattr(app, 'REPLAYED_RECENTLY', set())
+    monkeypatch.setattr(app, 'ANSWERED', app.AnsweredSets())
+    app.configure_prediction({})
+    assert not app.ANSWER_STORE.loaded
+    assert app.REPLAYED_ID == suite['new_submission2'].id
+    user, question = suite['new_user'], suite['new_question']
+    assert app.answered_bits(user.id) == 0
+    applied = []
+    app.SUBMISSION_LISTENERS.append(
+        lambda *args: applied.append(args))
+    # stored by another worker
+    db_session.add(app.Submission(user_id=user.id, question_id=question.id,
+                                  answer=2))
+    db_session.flush()
+    app.GENERATION.bump()
+    app.catch_up()
+    assert app.Submission.exists(user, question)
+    assert app.ANSWERED.get(user.id) == 1 << question.id
+    app.GENERATION.bump()
+    app.catch_up()
+    assert applied == [(user.id, question.id, 2)]
+
+
+# Test 63
+# the prediction served with the next question already counts the answer
+# just given, whichever backend reads the answer store
+def test_prediction_counts_answer_just_given(suite, new_questions, new_users,
+                                             new_submissions, answer_store,
+                                             db_session, monkeypatch):
+    from webtest import TestApp
+    first, following = new_questions[0], new_questions[1]
+    monkeypatch.setattr(
+        app.Question, 'get_random_unanswered',
+        classmethod(lambda cls, user, session=None, exclude=(): following))
+    for engine in ('lstsq', 'ridge', 'precomputed', 'factorization'):
+        # a user with no answers before this one
+        username = 'Test_Newcomer_' + engine
+        app.User.new(username=username, password='testpassword',
+                     session=db_session)
+        db_session.flush()
+        monkeypatch.setenv('PREDICTOR', engine)
+        testapp = TestApp(app.app())
+        params = {
+            'username': username,
+            'password': 'testpassword'
+        }
+        testapp.post('/login', params=params, status='3*')
+        params = {
+            'question_id': first.id,
+            'answer': '4'
+        }
+        response = testapp.post('/question', params=params, status='2*')
+        assert 'Prediction: 4' in response.body, engine
+
+
+# Test 64
+# serving from a single process writes out the answers still queued when
+# it is stopped
+def test_serve_single_shutdown(suite, reset_prediction, monkeypatch):
+    import prefork
+    from webtest import TestApp
+    monkeypatch.setenv('WRITE_BEHIND', '1')
+    monkeypatch.setattr(app, 'WRITER', None)
+    # without the writer's thread the answer stays queued until shutdown
+    monkeypatch.setattr(app.SubmissionWriter, 'start', lambda self: None)
+    user, question = suite['new_user'], suite['new_question']
+    queued = []
+
+    def run(server):
+        testapp = TestApp(server.application)
+        params = {
+            'username': 'Test_Username',
+            'password': 'testpassword'
+        }
+        testapp.post('/login', params=params, status='3*')
+        params = {'question_id': question.id, 'answer': '4'}
+        testapp.post('/question', params=params, status='2*')
+        queued.append(app.WRITER.is_pending(user.id, question.id))
+        server.task_dispatcher.shutdown()
+        server.close()
+
+    monkeypatch.setattr(prefork, 'run', run)
+    app.serve_single(host='127.0.0.1', port=0)
+    assert queued == [True]
+    assert not app.WRITER.is_pending(user.id, question.id)
+    assert app.Submission.get_user_answers(user.id) == [(question.id, 4)]
+
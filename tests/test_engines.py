@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engines import make_engine, settings_from_env
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+postgres = pytest.mark.skipif(
+    not (DATABASE_URL or '').startswith('postgresql'),
+    reason="needs a PostgreSQL DATABASE_URL")
+
+
+# Test 1
+# the environment gives the settings, with defaults for the rest
+def test_settings_from_env(monkeypatch):
+    monkeypatch.setenv('DB_POOL_SIZE', '20')
+    monkeypatch.delenv('DB_MAX_OVERFLOW', raising=False)
+    settings = settings_from_env()
+    assert settings['db_pool_size'] == '20'
+    assert settings['db_max_overflow'] == 10
+
+
+# Test 2
+# sqlite engines skip the pool settings it does not take
+def test_sqlite_engine():
+    engine = make_engine('sqlite://', {'db_pool_size': 3})
+    assert engine.scalar('select 1') == 1
+
+
+# Test 3
+# pool size and statement timeout come from the settings
+@postgres
+def test_postgres_engine():
+    engine = make_engine(DATABASE_URL, {'db_pool_size': 3,
+                                        'db_statement_timeout': 1500})
+    assert engine.pool.size() == 3
+    assert engine.scalar('show statement_timeout') == '1500ms'
+    engine.dispose()
+
+
+# Test 4
+# a pooled connection the server has dropped is replaced before use
+@postgres
+def test_pre_ping():
+    engine = make_engine(DATABASE_URL, {'db_pool_size': 1,
+                                        'db_max_overflow': 0})
+    pid = engine.scalar('select pg_backend_pid()')
+    other = make_engine(DATABASE_URL, {'db_pre_ping': 'false'})
+    other.scalar('select pg_terminate_backend(%d)' % pid)
+    other.dispose()
+    assert engine.scalar('select pg_backend_pid()') != pid
+    engine.dispose()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import evaluate
+
+
+# Fixture 1
+# 40 users answering 6 questions, the odd ones copying the even ones
+@pytest.fixture(scope="module")
+def rows():
+    rng = np.random.RandomState(1)
+    rows = []
+    for user_id in range(1, 41):
+        for question_id in (1, 3, 5):
+            answer = rng.randint(1, 6)
+            rows.append((user_id, question_id, answer))
+            rows.append((user_id, question_id + 1, answer))
+    return rows
+
+
+# Test 1
+# k-fold splits cover every row once and loo gives single row folds
+def test_split():
+    folds = evaluate.split(10, folds=3)
+    assert sorted(np.concatenate(folds)) == list(range(10))
+    assert [len(f) for f in folds] == [4, 3, 3]
+    folds = evaluate.split(10, loo=True, sample=4)
+    assert len(folds) == 4 and all(len(f) == 1 for f in folds)
+
+
+# Test 2
+# engines are scored on the answers held out from them
+def test_evaluate(rows):
+    scores = evaluate.evaluate(rows, ['lstsq', 'ridge'], folds=4,
+                               processes=1)
+    for engine in ('lstsq', 'ridge'):
+        score = scores[engine]
+        assert score['held_out'] == len(rows)
+        assert score['coverage'] > 0.5
+        assert score['mae'] < 1
+        assert score['latency_p99_ms'] >= score['latency_p50_ms']
+    assert scores['lstsq']['exact_match'] > 0.7
+
+
+# Test 3
+# the folds can be spread over processes with the same results
+def test_evaluate_parallel(rows):
+    serial = evaluate.evaluate(rows, ['ridge'], loo=True, sample=12,
+                               processes=1)['ridge']
+    parallel = evaluate.evaluate(rows, ['ridge'], loo=True, sample=12,
+                                 processes=2)['ridge']
+    assert parallel['held_out'] == serial['held_out'] == 12
+    assert abs(parallel['mae'] - serial['mae']) < 1e-9
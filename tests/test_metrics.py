@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import pytest
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+
+
+# Fixture 1
+# stats for a request being served by this thread
+@pytest.fixture(scope="function")
+def stats(request):
+    stats = metrics._local.stats = metrics.RequestStats()
+
+    def cleanup():
+        metrics._local.stats = None
+    request.addfinalizer(cleanup)
+    return stats
+
+
+# Test 1
+# statements run on an instrumented engine are counted and timed
+def test_instrument(stats):
+    engine = sa.create_engine('sqlite://')
+    metrics.instrument(engine)
+    metrics.instrument(engine)
+    engine.execute('select 1')
+    engine.execute('select 2')
+    assert stats.queries == 2
+    assert stats.db_time > 0
+
+
+# Test 2
+# timed functions add to the request's timers, and only inside requests
+def test_timed(stats):
+    @metrics.timed('guess')
+    def guess(x):
+        return x * 2
+    assert guess(2) == 4
+    assert guess(3) == 6
+    assert list(stats.timers) == ['guess']
+    metrics._local.stats = None
+    assert guess(4) == 8
+
+
+# Test 3
+# totals are rendered one per line
+def test_render(stats):
+    totals = metrics.Metrics()
+    stats.queries = 3
+    stats.timers['make_data'] = 0.5
+    totals.record('question', stats, 1.0)
+    stats.queries = 7
+    totals.record('question', stats, 1.0)
+    text = totals.render([('prediction_cache_hits', 4)])
+    assert 'requests_total 2\n' in text
+    assert 'queries_per_request_max 7\n' in text
+    assert 'make_data_seconds_total 1.0\n' in text
+    assert 'queries_total{route="question"} 10\n' in text
+    assert text.endswith('prediction_cache_hits 4\n')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from passwords import PasswordPool, PasswordPoolBusy
+
+
+# Fixture 1
+# pool with a single worker process and a cheap cost factor
+@pytest.fixture(scope="function")
+def pool(request):
+    pool = PasswordPool(workers=1, rounds=4, queue_size=1)
+    request.addfinalizer(pool.close)
+    return pool
+
+
+# Test 1
+# hashes made by the workers check out
+def test_encode_check(pool):
+    hashed = pool.encode("testpassword")
+    assert hashed.startswith("$2a$04$")
+    assert pool.check(hashed, "testpassword")
+    assert not pool.check(hashed, "wrongpassword")
+
+
+# Test 2
+# calls fail fast once the queue is full
+def test_busy(pool):
+    pool.slots.acquire()
+    with pytest.raises(PasswordPoolBusy):
+        pool.encode("testpassword")
+    pool.slots.release()
+    assert pool.encode("testpassword")
+
+
+# Test 3
+# without workers the hashing happens inline
+def test_inline():
+    pool = PasswordPool(rounds=4)
+    assert pool.pool is None
+    assert pool.check(pool.encode("testpassword"), "testpassword")
+    pool.close()
+
+
+# Test 4
+# a call the workers do not finish in time counts as the pool being busy
+def test_timeout(request):
+    pool = PasswordPool(workers=1, rounds=14, timeout=0.01)
+    request.addfinalizer(pool.close)
+    with pytest.raises(PasswordPoolBusy):
+        pool.encode("testpassword")
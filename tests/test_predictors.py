@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import AnswerStore
+from predictors import (LstsqPredictor, RidgePredictor,
+                        PrecomputedPredictor, FactorizationPredictor,
+                        CachedPredictor, Predictor, lstsq_all)
+
+
+# Fixture 1
+# 200 users answering questions 1 to 3, where question 3 is
+# question 1 plus question 2 minus 3, and user 1 who answered 1 and 2
+@pytest.fixture(scope="function")
+def store():
+    rng = np.random.RandomState(0)
+    rows = []
+    for user in range(2, 202):
+        a, b = rng.randint(2, 5, size=2)
+        rows += [(user, 1, a), (user, 2, b), (user, 3, a + b - 3)]
+    rows += [(1, 1, 4), (1, 2, 3)]
+    store = AnswerStore()
+    store.load(rows)
+    return store
+
+
+# Test 1
+# the ridge backend recovers a linear relationship
+def test_ridge_predict(store):
+    ridge = RidgePredictor(store, alpha=0.001)
+    ridge.fit()
+    assert abs(ridge.predict(3, 1) - 4) < 0.05
+
+
+def guess(x, u, y):
+    A = np.vstack(x + [np.ones(len(y))]).T
+    return np.linalg.lstsq(A, y)[0].dot(u + [1])
+
+
+# Test 2
+# the lstsq reference backend agrees with the ridge backend
+def test_lstsq_predict(store):
+    lstsq = LstsqPredictor(store.make_data, guess)
+    assert abs(lstsq.predict(3, 1) - 4) < 1e-6
+
+
+# Test 3
+# updating the statistics one answer at a time matches fitting them
+def test_ridge_update(store):
+    ridge = RidgePredictor(store)
+    ridge.fit()
+    for question, answer in [(3, 2), (7, 5), (2, 1)]:
+        ridge.update(300, question, answer)
+        store.add(300, question, answer)
+    ridge.update(1, 1, 5)    # already answered, ignored
+    fitted = RidgePredictor(store)
+    fitted.fit()
+    slots = ridge.slots([1, 2, 3, 7])
+    fitted_slots = fitted.slots([1, 2, 3, 7])
+    for name in ('n', 's', 'p'):
+        assert (getattr(ridge, name)[np.ix_(slots, slots)] ==
+                getattr(fitted, name)[np.ix_(fitted_slots, fitted_slots)]
+                ).all()
+
+
+# Test 4
+# nothing is predicted without overlapping answers
+def test_ridge_not_enough_data(store):
+    ridge = RidgePredictor(store)
+    ridge.fit()
+    assert ridge.predict(3, 500) is None
+    assert ridge.predict(40, 1) is None
+
+
+# Test 5
+# precomputed models predict with a dot product
+def test_precomputed_predict(store):
+    precomputed = PrecomputedPredictor(store, alpha=0.001)
+    precomputed.refresh()
+    model = precomputed.models[3]
+    assert model.version == 1
+    assert sorted(model.questions) == [1, 2]
+    assert abs(precomputed.predict(3, 1) - 4) < 0.05
+    assert precomputed.predict(3, 500) is None
+
+
+# Test 6
+# enough new submissions swap in a new version of the models
+def test_precomputed_refresh(store):
+    precomputed = PrecomputedPredictor(store, refresh_after=2)
+    precomputed.fit()
+    try:
+        assert precomputed.version == 1
+        store.add(300, 1, 2)
+        precomputed.update(300, 1, 2)
+        store.add(300, 2, 2)
+        precomputed.update(300, 2, 2)
+        for i in range(100):
+            if precomputed.version == 2:
+                break
+            time.sleep(0.02)
+        assert precomputed.version == 2
+        assert precomputed.models[3].version == 2
+    finally:
+        precomputed.stop()
+    assert precomputed.thread is None
+
+
+# Fixture 2
+# 300 users with a rank 2 taste for 20 questions, each answering
+# about half of them
+@pytest.fixture(scope="function")
+def sparse_store():
+    rng = np.random.RandomState(1)
+    users = rng.normal(0, 1, (300, 2))
+    questions = rng.normal(0, 1, (20, 2))
+    answers = np.clip(np.round(3 + users.dot(questions.T)), 1, 5)
+    mask = rng.rand(300, 20) < 0.5
+    store = AnswerStore()
+    store.load((u + 1, q + 1, answers[u, q])
+               for u, q in zip(*np.nonzero(mask)))
+    return store, answers, mask
+
+
+# Test 7
+# the factorization fills in answers nobody shared with the user
+def test_factorization_predict(sparse_store):
+    store, answers, mask = sparse_store
+    factorization = FactorizationPredictor(store, rank=2, reg=0.05)
+    factorization.fit()
+    errors = [abs(factorization.predict(q + 1, u + 1) - answers[u, q])
+              for u, q in zip(*np.nonzero(~mask))]
+    baseline = [abs(answers[mask].mean() - answers[u, q])
+                for u, q in zip(*np.nonzero(~mask))]
+    assert np.mean(errors) < 0.6 * np.mean(baseline)
+
+
+# Test 8
+# a new user is fitted as their answers come in
+def test_factorization_update(sparse_store):
+    store, answers, mask = sparse_store
+    factorization = FactorizationPredictor(store, rank=2, reg=0.05)
+    factorization.fit()
+    assert factorization.predict(1, 400) is None
+    for q in range(1, 11):
+        factorization.update(400, q + 1, answers[0, q])
+        store.add(400, q + 1, answers[0, q])
+    assert abs(factorization.predict(1, 400) - answers[0, 0]) < 1.5
+    assert factorization.count == mask.sum() + 10
+
+
+# Test 9
+# lstsq_all solves each column over its own rows like lstsq would
+def test_lstsq_all():
+    rng = np.random.RandomState(2)
+    x = rng.randint(1, 6, (50, 3)).astype(float)
+    y = rng.randint(1, 6, (50, 4)).astype(float)
+    mask = rng.rand(50, 4) < 0.7
+    mask[:, 3] = False
+    u = [2, 3, 4]
+    predictions = lstsq_all(x, u, y, mask)
+    for i in range(3):
+        a = np.hstack([x, np.ones((50, 1))])[mask[:, i]]
+        beta = np.linalg.lstsq(a, y[mask[:, i], i])[0]
+        expected = min(max(beta.dot(u + [1]), 1), 5)
+        assert abs(predictions[i] - expected) < 1e-6
+    assert predictions[3] is None
+    # blocks of three rows, the last one short
+    chunked = lstsq_all(x, u, y, mask, chunk_size=48)
+    for i in range(3):
+        assert abs(chunked[i] - predictions[i]) < 1e-9
+    assert chunked[3] is None
+
+
+# Test 10
+# every backend predicts all unanswered questions the same as one at a time
+def test_predict_all(sparse_store):
+    store, answers, mask = sparse_store
+    store.add(400, 1, 3)
+    store.add(400, 2, 4)
+    ridge = RidgePredictor(store)
+    factorization = FactorizationPredictor(store, rank=2)
+    precomputed = PrecomputedPredictor(store)
+    lstsq = LstsqPredictor(store.make_data, guess, store.make_all_data)
+    for backend in (ridge, factorization, precomputed):
+        backend.fit()
+    precomputed.stop()
+    for user in (1, 400, 500):
+        questions = [q for q in range(1, 22) if store.get(user, q) is None]
+        for backend in (ridge, factorization, precomputed, lstsq):
+            predictions = backend.predict_all(questions, user)
+            for question in questions:
+                expected = backend.predict(question, user)
+                if expected is None:
+                    assert predictions[question] is None
+                else:
+                    assert abs(predictions[question] - expected) < 1e-6
+
+
+class CountingPredictor(Predictor):
+    """Predicts the question id and counts how often it is asked to"""
+
+    def __init__(self):
+        self.calls = 0
+        self.version = 0
+
+    def predict(self, question_id, user_id):
+        self.calls += 1
+        return question_id
+
+
+# Test 11
+# repeated predictions come from the cache until the user answers
+def test_cached_predict():
+    backend = CountingPredictor()
+    cached = CachedPredictor(backend, staleness=2)
+    assert cached.predict(3, 1) == 3
+    assert cached.predict(3, 1) == 3
+    assert cached.predict_all([3, 4], 1) == {3: 3, 4: 4}
+    assert backend.calls == 2
+    cached.update(1, 5, 2)
+    assert cached.predict(3, 1) == 3
+    assert cached.predict(3, 2) == 3
+    assert backend.calls == 4
+    stats = cached.stats()
+    assert (stats['hits'], stats['misses']) == (2, 4)
+
+
+# Test 12
+# everyone's predictions are redone as the data moves on
+def test_cached_versions():
+    backend = CountingPredictor()
+    cached = CachedPredictor(backend, staleness=2)
+    cached.predict(3, 1)
+    cached.update(2, 5, 2)
+    cached.predict(3, 1)
+    assert backend.calls == 1
+    cached.update(2, 6, 2)
+    cached.predict(3, 1)
+    assert backend.calls == 2
+    backend.version += 1
+    cached.predict(3, 1)
+    assert backend.calls == 3
+    cached.bump()
+    cached.predict(3, 1)
+    assert backend.calls == 4
+
+
+# Test 13
+# a user past the last row of the store can be fitted as they answer
+def test_factorization_update_new_row(sparse_store):
+    store, answers, mask = sparse_store
+    factorization = FactorizationPredictor(store, rank=2, reg=0.05)
+    factorization.fit()
+    user = store.shape[0]
+    for q in range(1, 4):
+        factorization.update(user, q + 1, answers[0, q])
+        store.add(user, q + 1, answers[0, q])
+    assert factorization.predict(1, user) is not None
+    assert factorization.count == mask.sum() + 3
+
+
+# Test 14
+# users past the last row of the store get no predictions from ridge
+def test_ridge_predict_all_new_row(store):
+    ridge = RidgePredictor(store)
+    ridge.fit()
+    user = store.shape[0]
+    assert ridge.predict(3, user) is None
+    assert ridge.predict_all([1, 2, 3], user) == {1: None, 2: None, 3: None}
+
+
+# Test 15
+# answers the store has not heard about yet count towards a prediction
+def test_predict_pending(store):
+    pending = [(1, 4), (2, 3)]
+    ridge = RidgePredictor(store, alpha=0.001)
+    precomputed = PrecomputedPredictor(store, alpha=0.001)
+    factorization = FactorizationPredictor(store, rank=2)
+    lstsq = CachedPredictor(LstsqPredictor(store.make_data, guess))
+    ridge.fit()
+    precomputed.refresh()
+    factorization.fit()
+    for backend in (ridge, precomputed, lstsq):
+        assert backend.predict(3, 500) is None
+        assert abs(backend.predict(3, 500, pending) - 4) < 0.05
+        assert abs(backend.predict(3, 1, [(2, 1)]) - 2) < 0.05
+    assert factorization.predict(3, 500) is None
+    assert abs(factorization.predict(3, 500, pending) -
+               factorization.predict(3, 1)) < 1e-6
+
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import signal
+import sys
+import time
+import urllib2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import prefork
+
+
+# Test 1
+# a bump in a forked process is seen by its parent
+def test_generation():
+    generation = prefork.Generation()
+    pid = os.fork()
+    if pid == 0:
+        generation.bump()
+        generation.bump()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert generation.value == 2
+
+
+def application(environ, start_response):
+    start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+
+# Test 2
+# workers serve the listening socket of the parent until it is stopped,
+# each running on_exit on the way out
+def test_serve(tmpdir):
+    sock = prefork.listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    exits = str(tmpdir.join('exits'))
+
+    def on_exit():
+        with open(exits, 'a') as f:
+            f.write('%d\n' % os.getpid())
+
+    parent = os.fork()
+    if parent == 0:
+        try:
+            prefork.serve(lambda: application, sock, 2, on_exit,
+                          host='127.0.0.1', port=port)
+        finally:
+            os._exit(0)
+    sock.close()
+    try:
+        pids = set()
+        deadline = time.time() + 10
+        while len(pids) < 2 and time.time() < deadline:
+            pids.add(int(urllib2.urlopen(
+                'http://127.0.0.1:%d/' % port, timeout=5).read()))
+        assert len(pids) == 2
+        assert parent not in pids
+    finally:
+        os.kill(parent, signal.SIGTERM)
+        os.waitpid(parent, 0)
+    with open(exits) as f:
+        assert set(int(line) for line in f) == pids
+
+
+# Test 3
+# run serves until SIGTERM and lets the process carry on after it
+def test_run():
+    from waitress.adjustments import Adjustments
+    sock = prefork.listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            prefork.run(prefork.InheritedSocketServer(
+                application, _sock=sock,
+                adj=Adjustments(host='127.0.0.1', port=port)))
+        finally:
+            os._exit(3)
+    sock.close()
+    status = None
+    try:
+        for i in range(20):
+            assert int(urllib2.urlopen(
+                'http://127.0.0.1:%d/' % port, timeout=5).read()) == pid
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + 10
+        while status is None and time.time() < deadline:
+            done, result = os.waitpid(pid, os.WNOHANG)
+            if done:
+                status = result
+            time.sleep(0.05)
+    finally:
+        if status is None:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+    assert status is not None
+    assert os.WEXITSTATUS(status) == 3
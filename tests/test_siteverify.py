@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import socket
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from siteverify import SiteVerifier, CaptchaUnavailable, start_stub
+
+
+# Fixture 1
+# stub siteverify server on a free port
+@pytest.fixture(scope="module")
+def stub(request):
+    server = start_stub()
+    request.addfinalizer(server.shutdown)
+    return server
+
+
+# Fixture 2
+# verifier pointed at the stub
+@pytest.fixture(scope="function")
+def verifier(request, stub):
+    verifier = SiteVerifier(stub.url, secret='secret', timeout=1)
+    request.addfinalizer(verifier.close)
+    return verifier
+
+
+def closed_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d/recaptcha/api/siteverify' % port
+
+
+# Test 1
+# the stub passes tokens other than "fail"
+def test_verify(verifier):
+    assert verifier.verify('token', '127.0.0.1')
+    assert not verifier.verify('fail')
+
+
+# Test 2
+# empty tokens are rejected without asking the endpoint
+def test_empty_token():
+    verifier = SiteVerifier(closed_url(), failures=1)
+    assert not verifier.verify('')
+    assert not verifier.verify(None)
+    assert verifier.failed == 0
+
+
+# Test 3
+# one connection is kept open and reused between calls
+def test_keep_alive(verifier):
+    verifier.verify('token')
+    connection = verifier.connections.queue[0]
+    verifier.verify('token')
+    assert list(verifier.connections.queue) == [connection]
+
+
+# Test 4
+# a connection closed while idle is replaced transparently
+def test_stale_connection(verifier):
+    verifier.verify('token')
+    verifier.connections.queue[0].sock.shutdown(socket.SHUT_RDWR)
+    assert verifier.verify('token')
+    assert verifier.failed == 0
+
+
+# Test 5
+# repeated failures open the circuit until reset_after has passed
+def test_circuit_breaker(monkeypatch):
+    verifier = SiteVerifier(closed_url(), failures=2, reset_after=30)
+    for i in range(2):
+        with pytest.raises(CaptchaUnavailable):
+            verifier.verify('token')
+    calls = []
+    monkeypatch.setattr(verifier, '_post', lambda body: calls.append(body))
+    with pytest.raises(CaptchaUnavailable):
+        verifier.verify('token')
+    assert calls == []
+    verifier.opened_at -= 30
+    monkeypatch.setattr(verifier, '_post', lambda body: {'success': True})
+    assert verifier.verify('token')
+    assert verifier.opened_at is None and verifier.failed == 0
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import snapshot
+from predictors import FactorizationPredictor
+from store import AnswerStore, QuestionStats
+
+
+# Fixture 1
+# (id, user_id, question_id, answer) rows of 30 users answering 3 questions
+@pytest.fixture(scope="function")
+def rows():
+    rng = np.random.RandomState(0)
+    return [(i + 1, i // 3 + 1, i % 3 + 1, rng.randint(1, 6))
+            for i in range(90)]
+
+
+# Test 1
+# a snapshot reads back as copy-on-write memory maps of what was saved
+def test_write_read(tmpdir, rows):
+    path = str(tmpdir.join('snapshot'))
+    parts, last_id = snapshot.take(rows, rank=2)
+    assert last_id == 90
+    snapshot.write(path, parts, last_id)
+    read_id, read = snapshot.read(path)
+    assert read_id == 90
+    assert sorted(read) == ['factorization', 'stats', 'store']
+    for part in parts:
+        for name, array in parts[part].items():
+            assert isinstance(read[part][name], np.memmap)
+            assert (read[part][name] == array).all()
+    read['store']['answers'][1, 1] = 0
+    assert snapshot.read(path)[1]['store']['answers'][1, 1] == rows[0][3]
+
+
+# Test 2
+# restored components carry on from the snapshot
+def test_restore(tmpdir, rows):
+    path = str(tmpdir.join('snapshot'))
+    snapshot.write(path, *snapshot.take(rows[:60], rank=2))
+    last_id, parts = snapshot.read(path)
+    store = AnswerStore()
+    stats = QuestionStats(store)
+    store.restore(parts['store'])
+    stats.restore(parts['stats'])
+    for _, user_id, question_id, answer in rows[last_id:]:
+        stats.update(user_id, question_id, answer)
+        store.add(user_id, question_id, answer)
+    fresh = AnswerStore()
+    fresh.load([row[1:] for row in rows])
+    fresh_stats = QuestionStats(fresh)
+    fresh_stats.fit()
+    assert store.loaded
+    assert (store.answers[:31, :4] == fresh.answers[:31, :4]).all()
+    assert (stats.n == fresh_stats.n).all()
+    assert abs(stats.p - fresh_stats.p).max() < 1e-9
+
+    predictor = FactorizationPredictor(store, rank=2)
+    assert predictor.restore(parts['factorization'])
+    assert predictor.count == 60
+    assert predictor.predict(1, 1) is not None
+    assert not FactorizationPredictor(store, rank=3).restore(
+        parts['factorization'])
+
+
+# Test 3
+# a new snapshot replaces the old one, whose directory is removed
+def test_replace(tmpdir, rows):
+    path = str(tmpdir.join('snapshot'))
+    snapshot.write(path, *snapshot.take(rows[:30]))
+    first = os.path.realpath(path)
+    snapshot.write(path, *snapshot.take(rows))
+    assert os.path.islink(path)
+    assert not os.path.exists(first)
+    assert snapshot.read(path)[0] == 90
+    assert len(tmpdir.listdir()) == 2
+
+
+# Test 4
+# snapshots written in another format are refused
+def test_version(tmpdir, rows):
+    path = str(tmpdir.join('snapshot'))
+    snapshot.write(path, *snapshot.take(rows))
+    meta = os.path.join(os.path.realpath(path), 'meta.json')
+    with open(meta) as f:
+        data = json.load(f)
+    data['version'] = 0
+    with open(meta, 'w') as f:
+        json.dump(data, f)
+    with pytest.raises(ValueError):
+        snapshot.read(path)
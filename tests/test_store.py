@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from store import (AnswerStore, AnsweredSets, QuestionStats, respondents,
+                   set_bits)
+
+
+# Fixture 1
+# store with 12 users answering questions 1 and 2, and user 1
+# answering question 1 only
+@pytest.fixture(scope="function")
+def store():
+    store = AnswerStore(users=4, questions=2)
+    rows = [(u, 1, 3) for u in range(2, 14)]
+    rows += [(u, 2, 5) for u in range(2, 14)]
+    rows.append((1, 1, 2))
+    store.load(rows)
+    return store
+
+
+# Test 1
+# loading grows the matrix to fit every id
+def test_load_grows(store):
+    assert store.loaded
+    assert store.shape == (16, 4)
+    assert store.answers[5, 2] == 5
+    assert store.mask[1, 1] and not store.mask[1, 2]
+
+
+# Test 2
+# adding an answer updates the matrix in place
+def test_add(store):
+    store.add(40, 9, 4)
+    assert store.answers[40, 9] == 4
+    assert list(store.answered(40)) == [9]
+    assert list(store.answered(1)) == [1]
+    assert list(store.answered(1000)) == []
+
+
+# Test 3
+# make_data slices x, u and y out of the matrix
+def test_make_data(store):
+    x, u, y = store.make_data(2, 1)
+    assert [list(row) for row in x] == [[3] * 12]
+    assert u == [2]
+    assert list(y) == [5] * 12
+
+
+# Test 4
+# questions with too few respondents are left out
+def test_make_data_minimum(store):
+    x, u, y = store.make_data(2, 1, minimum=14)
+    assert x == [] and u == []
+    assert list(y) == [5] * 12
+
+
+# Test 5
+# clearing forgets everything
+def test_clear(store):
+    store.clear()
+    assert not store.loaded
+    assert not store.mask.any()
+
+
+# Test 6
+# the bitsets and counts agree with the mask as answers come in
+def test_bits_and_counts(store):
+    store.add(1, 2, 4)
+    store.add(1, 2, 3)
+    store.add(37, 2, 1)
+    assert list(store.counts[:3]) == [0, 13, 14]
+    assert (np.unpackbits(store.bits, axis=1)[:, :store.shape[0]] ==
+            store.mask.T).all()
+
+
+# Test 7
+# respondents ANDs the bitsets together
+def test_respondents():
+    columns = np.zeros((3, 20), dtype=bool)
+    columns[0, [1, 2, 3, 9, 17]] = True
+    columns[1, [2, 3, 9, 17, 18]] = True
+    columns[2, [0, 3, 9, 17]] = True
+    bitsets = np.packbits(columns.view(np.uint8), axis=1)
+    assert list(respondents(bitsets)) == [3, 9, 17]
+
+
+# Fixture 2
+# 30 users where question 2 copies question 1 and question 3 reverses it,
+# question 4 is unrelated and user 1 has answered question 1 only
+@pytest.fixture(scope="function")
+def stats():
+    rng = np.random.RandomState(0)
+    rows = []
+    for user in range(2, 32):
+        a, b = rng.randint(1, 6, size=2)
+        rows += [(user, 1, a), (user, 2, a), (user, 3, 6 - a), (user, 4, b)]
+    rows.append((1, 1, 3))
+    store = AnswerStore()
+    store.load(rows)
+    stats = QuestionStats(store)
+    stats.fit()
+    return stats
+
+
+# Test 8
+# updating the statistics one answer at a time matches fitting them
+def test_question_stats_update(stats):
+    store = stats.store
+    for user, question, answer in [(1, 2, 4), (1, 4, 2), (40, 9, 5),
+                                   (40, 1, 3)]:
+        stats.update(user, question, answer)
+        store.add(user, question, answer)
+    stats.update(1, 2, 1)    # already answered, ignored
+    fitted = QuestionStats(store)
+    fitted.fit()
+    slots = stats.slots([1, 2, 3, 4, 9])
+    fitted_slots = fitted.slots([1, 2, 3, 4, 9])
+    for name in ('n', 's', 'q', 'p'):
+        assert (getattr(stats, name)[np.ix_(slots, slots)] ==
+                getattr(fitted, name)[np.ix_(fitted_slots, fitted_slots)]
+                ).all()
+
+
+# Test 9
+# correlations come out of the statistics
+def test_question_stats_correlation(stats):
+    correlation = stats.correlation(stats.slots([1, 2, 3, 4]))
+    assert abs(correlation[0, 1] - 1) < 1e-9
+    assert abs(correlation[0, 2] + 1) < 1e-9
+    assert abs(correlation[0, 3]) < 0.5
+    assert (abs(correlation.diagonal() - 1) < 1e-9).all()
+
+
+# Test 10
+# select keeps the most correlated questions with enough overlap
+def test_question_stats_select(stats):
+    assert sorted(stats.select(2, [4, 3, 1, 2, 7], 2)) == [1, 3]
+    assert list(stats.select(2, [4, 3, 1], 5, minimum=31)) == []
+    assert list(stats.select(8, [1, 3], 5)) == []
+
+
+# Test 11
+# answered sets hold the questions of cached users and drop the oldest
+def test_answered_sets():
+    answered = AnsweredSets(size=2)
+    assert answered.get(1) is None
+    answered.add(1, 3)
+    assert answered.get(1) is None
+    assert answered.load(1, [2, 70]) == 1 << 2 | 1 << 70
+    answered.add(1, 3)
+    assert set_bits(answered.get(1)) == [2, 3, 70]
+    assert set_bits(answered.load(2, [])) == []
+    answered.load(3, [1])
+    assert answered.get(1) is None
+    answered.discard(3)
+    assert answered.get(3) is None
+    assert answered.stats()['entries'] == 1
+
+
+# Test 12
+# a user past the last row of the store can be added to the statistics
+def test_question_stats_new_user(stats):
+    store = stats.store
+    user = store.shape[0]
+    assert store.user_answers(user)[0].tolist() == []
+    for question, answer in [(1, 4), (2, 4)]:
+        stats.update(user, question, answer)
+        store.add(user, question, answer)
+    assert store.user_answers(user)[1].tolist() == [4, 4]
+    fitted = QuestionStats(store)
+    fitted.fit()
+    assert (stats.n == fitted.n).all()
+    assert (stats.p == fitted.p).all()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import pytest
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from writer import SubmissionWriter
+
+
+# Fixture 1
+# answers table with one answer per user and question, in a sqlite file
+@pytest.fixture(scope="function")
+def table(tmpdir):
+    engine = sa.create_engine('sqlite:///%s' % tmpdir.join('answers.db'))
+    metadata = sa.MetaData()
+    table = sa.Table(
+        'answers', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer),
+        sa.Column('question_id', sa.Integer),
+        sa.Column('answer', sa.Integer),
+        sa.UniqueConstraint('user_id', 'question_id'))
+    metadata.create_all(engine)
+    table.engine = engine
+    return table
+
+
+def rows(table):
+    return sorted(tuple(row) for row in table.engine.execute(sa.select(
+        [table.c.user_id, table.c.question_id, table.c.answer])))
+
+
+# Test 1
+# answers are pending until flushed, then written in batches
+def test_flush(table):
+    writer = SubmissionWriter(table.engine, table, batch_size=2)
+    for question_id in range(1, 6):
+        assert writer.submit(1, question_id, question_id)
+    assert writer.is_pending(1, 3)
+    assert not writer.is_pending(2, 3)
+    assert sorted(writer.pending_answers(1)) == [(q, q) for q in range(1, 6)]
+    assert writer.pending_answers(2) == []
+    assert rows(table) == []
+    writer.flush()
+    assert rows(table) == [(1, q, q) for q in range(1, 6)]
+    assert not writer.is_pending(1, 3)
+    stats = writer.stats()
+    assert stats['written'] == 5
+    assert stats['batches'] == 3
+    assert stats['queue_depth'] == 0
+    assert stats['pending'] == 0
+
+
+# Test 2
+# a batch holding an answer already in the table is written row by row
+def test_duplicate(table):
+    table.engine.execute(table.insert().values(
+        user_id=1, question_id=2, answer=4))
+    writer = SubmissionWriter(table.engine, table)
+    writer.submit(1, 1, 1)
+    writer.submit(1, 2, 2)
+    writer.submit(1, 3, 3)
+    writer.flush()
+    assert rows(table) == [(1, 1, 1), (1, 2, 4), (1, 3, 3)]
+    assert writer.stats()['written'] == 2
+    assert writer.stats()['failed'] == 1
+
+
+# Test 3
+# a full queue turns answers away, and answering twice is ignored
+def test_full_queue(table):
+    writer = SubmissionWriter(table.engine, table, max_queue=2)
+    assert writer.submit(1, 1, 1)
+    assert writer.submit(1, 1, 5)
+    assert writer.submit(1, 2, 2)
+    assert not writer.submit(1, 3, 3)
+    assert not writer.is_pending(1, 3)
+    writer.flush()
+    assert rows(table) == [(1, 1, 1), (1, 2, 2)]
+
+
+# Test 4
+# the background thread writes what is submitted and stop drains the queue
+def test_background(table):
+    writer = SubmissionWriter(table.engine, table, interval=0.05)
+    writer.start()
+    writer.submit(1, 1, 1)
+    deadline = time.time() + 5
+    while writer.is_pending(1, 1) and time.time() < deadline:
+        time.sleep(0.01)
+    assert rows(table) == [(1, 1, 1)]
+    writer.submit(1, 2, 2)
+    writer.stop()
+    assert rows(table) == [(1, 1, 1), (1, 2, 2)]
+    assert writer.stats()['max_lag'] > 0
+
+
+# Test 5
+# a batch that cannot be written is kept and tried again
+def test_retry(table):
+    writer = SubmissionWriter(table.engine, table, retry_interval=0.01)
+    insert = writer._insert
+    failures = []
+
+    def flaky(rows):
+        if len(failures) < 2:
+            failures.append(rows)
+            raise sa.exc.OperationalError('INSERT', {}, Exception('down'))
+        insert(rows)
+
+    writer._insert = flaky
+    writer.submit(1, 1, 1)
+    assert not writer.flush()
+    assert writer.is_pending(1, 1)
+    assert rows(table) == []
+    writer.submit(1, 2, 2)
+    writer.stop()
+    assert rows(table) == [(1, 1, 1), (1, 2, 2)]
+    stats = writer.stats()
+    assert stats['retries'] == 2
+    assert stats['written'] == 2 and stats['failed'] == 0
+    assert stats['pending'] == 0
+
@@ -0,0 +1,209 @@
+"""Write-behind queue for answer submissions"""
+import logging
+import Queue
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+log = logging.getLogger(__name__)
+
+
+class SubmissionWriter(object):
+    """Accepts submissions straight away and inserts them into table from
+    a background thread, batch_size rows per multi-row INSERT or whatever
+    has come in every interval seconds. Until they are written the
+    submissions are kept in pending, so that they can be looked up.
+    submit refuses submissions once max_queue are waiting, leaving the
+    caller to write them itself. A batch that cannot be written, say
+    because the database is down, is kept and tried again, waiting
+    retry_interval seconds at first and twice as long after every
+    failure up to max_retry_interval. on_write, if given, is called
+    after every batch written."""
+
+    def __init__(self, bind, table, batch_size=500, interval=1.0,
+                 max_queue=10000, on_write=None, retry_interval=1.0,
+                 max_retry_interval=60.0):
+        self.bind = bind
+        self.on_write = on_write
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.pending = {}
+        # a batch taken off the queue that failed to be written
+        self.retrying = []
+        self.written = self.batches = self.failed = self.retries = 0
+        self.last_lag = self.max_lag = 0.0
+        self.thread = None
+        self._stop = threading.Event()
+
+    def submit(self, user_id, question_id, answer):
+        """Queues an answer for writing. Returns False when the queue is
+        full and the answer was not taken."""
+        with self.lock:
+            if (user_id, question_id) in self.pending:
+                return True
+            try:
+                self.queue.put_nowait(
+                    (time.time(), user_id, question_id, answer))
+            except Queue.Full:
+                return False
+            self.pending[user_id, question_id] = answer
+        return True
+
+    def is_pending(self, user_id, question_id):
+        with self.lock:
+            return (user_id, question_id) in self.pending
+
+    def pending_answers(self, user_id):
+        """Returns the (question_id, answer) pairs of a user that are still
+        waiting to be written"""
+        with self.lock:
+            return [(question_id, answer) for (user, question_id), answer
+                    in self.pending.items() if user == user_id]
+
+    def _take(self, timeout=None):
+        """Returns up to batch_size queued items, or the batch to try
+        again if there is one. With a timeout, waits that long for the
+        first item and then up to interval seconds for the batch to fill
+        up; without one, takes only what is waiting."""
+        with self.lock:
+            if self.retrying:
+                items, self.retrying = self.retrying, []
+                return items
+        items = []
+        try:
+            if timeout is None:
+                while len(items) < self.batch_size:
+                    items.append(self.queue.get_nowait())
+                return items
+            items.append(self.queue.get(True, timeout))
+            deadline = time.time() + self.interval
+            while len(items) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                items.append(self.queue.get(True, remaining))
+        except Queue.Empty:
+            pass
+        return items
+
+    def _insert(self, rows):
+        connection = self.bind.connect()
+        try:
+            with connection.begin():
+                connection.execute(self.table.insert().values(rows))
+        finally:
+            connection.close()
+
+    def _write(self, items):
+        """Inserts a batch, falling back to one row at a time when the
+        batch holds an answer that is already in the table. Returns
+        False, keeping the batch to be tried again, when it could not be
+        written."""
+        rows = [{'user_id': user_id, 'question_id': question_id,
+                 'answer': answer} for _, user_id, question_id, answer
+                in items]
+        failed = 0
+        try:
+            try:
+                self._insert(rows)
+            except IntegrityError:
+                for row in rows:
+                    try:
+                        self._insert([row])
+                    except IntegrityError:
+                        failed += 1
+        except Exception:
+            # rows written one at a time before the failure come back as
+            # duplicates on the next try and are counted as failed then
+            log.exception("Could not write %d submissions", len(rows))
+            with self.lock:
+                self.retrying = items + self.retrying
+                self.retries += 1
+            return False
+        lag = time.time() - items[0][0]
+        with self.lock:
+            for _, user_id, question_id, _ in items:
+                self.pending.pop((user_id, question_id), None)
+            self.written += len(items) - failed
+            self.failed += failed
+            self.batches += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+        if self.on_write is not None:
+            self.on_write()
+        return True
+
+    def _backoff(self, delay):
+        """The wait before the next try after one that waited delay"""
+        return min(delay * 2, self.max_retry_interval)
+
+    def flush(self, attempts=1):
+        """Writes everything queued so far from the calling thread,
+        trying a batch that fails up to attempts times. Returns False
+        when a batch could not be written, which is left to try again."""
+        delay = self.retry_interval
+        failures = 0
+        while True:
+            items = self._take()
+            if not items:
+                return True
+            if self._write(items):
+                failures = 0
+                delay = self.retry_interval
+                continue
+            failures += 1
+            if failures >= attempts:
+                return False
+            time.sleep(delay)
+            delay = self._backoff(delay)
+
+    def start(self):
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        delay = self.retry_interval
+        while not self._stop.is_set():
+            items = self._take(self.interval)
+            if not items:
+                continue
+            if self._write(items):
+                delay = self.retry_interval
+            else:
+                self._stop.wait(delay)
+                delay = self._backoff(delay)
+
+    def stop(self, attempts=3):
+        """Stops the background thread and writes what is queued, trying
+        a failing batch up to attempts times before giving up on it and
+        everything still queued"""
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if not self.flush(attempts):
+            with self.lock:
+                lost = len(self.pending)
+            log.error("Lost %d submissions", lost)
+
+    def stats(self):
+        """Queue depth, throughput and how long answers waited"""
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'pending': len(self.pending),
+                'written': self.written,
+                'failed': self.failed,
+                'retries': self.retries,
+                'batches': self.batches,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+            }